@@ -1,7 +1,7 @@
 import abc
 import numpy as np
 import homog as hm
-from numpy.linalg import inv
+from .util import rigid_inv
 
 
 Ux = np.array([1, 0, 0, 0])
@@ -9,12 +9,52 @@ Uy = np.array([0, 1, 0, 0])
 Uz = np.array([0, 0, 1, 0])
 
 
+def angle_error_lower_bound(cosang, target):
+    """lower bound on abs(arccos(cosang) - target), allowing for rounding
+    error in cosang, which arccos amplifies near +-1"""
+    eps = 64 * np.finfo(np.result_type(cosang, np.float32)).eps
+    lo = np.arccos(np.clip(cosang + eps, -1, 1))
+    hi = np.arccos(np.clip(cosang - eps, -1, 1))
+    return np.maximum(0, np.maximum(lo - target, target - hi))
+
+
+def projection_lower_bound(t, v, slack, trans_slack):
+    """lower bound on abs(t' . v') / norm(v') for any t' within trans_slack
+    of t and v' within slack of v, where norm(v') <= 1"""
+    vmax = np.minimum(1, np.linalg.norm(v, axis=-1) + slack)
+    dot = (np.abs(np.sum(t * v, axis=-1)) - trans_slack * vmax -
+           np.linalg.norm(t, axis=-1) * slack)
+    return np.maximum(0, dot) / np.maximum(vmax, 1e-9)
+
+
+def relative_xform(segpos, from_seg, to_seg):
+    "inv(x_lo) @ x_hi, lo/hi the lower/higher of from_seg/to_seg"
+    nseg = len(segpos)
+    lo, hi = sorted((from_seg % nseg, to_seg % nseg))
+    return rigid_inv(segpos[lo]) @ segpos[hi]
+
+
 class WormCriteria(abc.ABC):
 
     @abc.abstractmethod
     def score(self, **kw):
         pass
 
+    def score_lower_bound(self, segpos, **kw):
+        """cheap lower bound on score, 0 if a criteria has none
+
+        with slack, bound for any worm whose relative_xform rotation is
+        within slack radians of the one in segpos; with trans_slack also
+        its translation within trans_slack, else translation is ignored"""
+        return 0
+
+    def positions_used(self, nseg):
+        """indices of the segments whose positions score reads"""
+        return set(range(nseg))
+
+    # score unchanged if all segment positions are moved by the same xform
+    rigid_invariant = False
+
     allowed_attributes = ('last_body_same_as',
                           'symname',
                           'is_cyclic',
@@ -37,6 +77,16 @@ class CriteriaList(WormCriteria):
     def score(self, **kw):
         return sum(c.score(**kw) for c in self.children)
 
+    def score_lower_bound(self, **kw):
+        return sum(c.score_lower_bound(**kw) for c in self.children)
+
+    def positions_used(self, nseg):
+        return set().union(*(c.positions_used(nseg) for c in self.children))
+
+    @property
+    def rigid_invariant(self):
+        return all(c.rigid_invariant for c in self.children)
+
     def __getattr__(self, name):
         if name not in WormCriteria.allowed_attributes:
             raise AttributeError('CriteriaList has no attribute: ' + name)
@@ -58,6 +108,8 @@ class CriteriaList(WormCriteria):
 
 class NullCriteria(WormCriteria):
 
+    rigid_invariant = True
+
     def __init__(self, from_seg=0, to_seg=-1, origin_seg=None):
         self.from_seg = from_seg
         self.to_seg = to_seg
@@ -65,6 +117,9 @@ class NullCriteria(WormCriteria):
     def score(self, segpos, **kw):
         return np.zeros(segpos[-1].shape[:-2])
 
+    def positions_used(self, nseg):
+        return {nseg - 1}
+
     def alignment(self, segpos, **kw):
         r = np.empty_like(segpos[-1])
         r[..., :, :] = np.eye(4)
@@ -73,6 +128,8 @@ class NullCriteria(WormCriteria):
 
 class AxesIntersect(WormCriteria):
 
+    rigid_invariant = True
+
     def __init__(self, symname, tgtaxis1, tgtaxis2, from_seg, *, tol=1.0,
                  lever=50, to_seg=-1, distinct_axes=False):
         if from_seg == to_seg:
@@ -115,6 +172,29 @@ class AxesIntersect(WormCriteria):
         roterr2 = (ang - self.angle)**2
         return np.sqrt(roterr2 / self.rot_tol**2 + (dist / self.tol)**2)
 
+    def positions_used(self, nseg):
+        return {self.from_seg % nseg, self.to_seg % nseg}
+
+    def score_lower_bound(self, segpos, slack=0, trans_slack=None, **kw):
+        """rotation term of score from the axis angle; with trans_slack
+        and not distinct_axes also the axis distance, which in the frame
+        of the lower segment is abs(t . c) / norm(c), c = z cross axis"""
+        ax1 = segpos[self.from_seg][..., :3, 2]
+        ax2 = segpos[self.to_seg][..., :3, 2]
+        cosang = np.abs(np.sum(ax1 * ax2, axis=-1))
+        err = angle_error_lower_bound(cosang, self.angle)
+        if self.distinct_axes:  # axes may be flipped, angle is pi - ang
+            err = np.minimum(err, angle_error_lower_bound(
+                -cosang, self.angle))
+        roterr = np.maximum(0, err - slack) / self.rot_tol
+        if trans_slack is None or self.distinct_axes: return roterr
+        x = relative_xform(segpos, self.from_seg, self.to_seg)
+        ax = x[..., :3, 2]
+        c = np.stack([-ax[..., 1], ax[..., 0], np.zeros(ax.shape[:-1])],
+                     axis=-1)
+        dist = projection_lower_bound(x[..., :3, 3], c, slack, trans_slack)
+        return np.sqrt(roterr**2 + (dist / self.tol)**2)
+
     def alignment(self, segpos, debug=0, **kw):
         cen1 = segpos[self.from_seg][..., :, 3]
         cen2 = segpos[self.to_seg][..., :, 3]
@@ -232,6 +312,8 @@ class Cyclic(WormCriteria):
         else: raise ValueError('can only do Cx symmetry for now')
         if self.tol <= 0: raise ValueError('tol should be > 0')
         self.last_body_same_as = self.from_seg
+        # nfold 1 scores the translation of xhat, which is not invariant
+        self.rigid_invariant = origin_seg is None and self.nfold > 1
         self.is_cyclic = True
         self.symname = None
         if self.nfold > 1:
@@ -241,7 +323,7 @@ class Cyclic(WormCriteria):
     def score(self, segpos, *, verbosity=False, **kw):
         x_from = segpos[self.from_seg]
         x_to = segpos[self.to_seg]
-        xhat = x_to @ inv(x_from)
+        xhat = x_to @ rigid_inv(x_from)
         trans = xhat[..., :, 3]
         if self.nfold is 1:
             angle = hm.angle_of(xhat)
@@ -275,12 +357,39 @@ class Cyclic(WormCriteria):
         return np.sqrt(carterrsq / self.tol**2 +
                        roterrsq / self.rot_tol**2)
 
+    def positions_used(self, nseg):
+        used = {self.from_seg % nseg, self.to_seg % nseg}
+        if self.origin_seg is not None:
+            used.add(self.origin_seg % nseg)
+        return used
+
+    def score_lower_bound(self, segpos, slack=0, trans_slack=None, **kw):
+        """rotation angle error, angle from the trace of x_to @
+        inv(x_from) without forming it; with trans_slack, nfold > 1 and no
+        origin_seg also the translation along the axis, abs(t . v) /
+        norm(v) with v the axis times sin(angle)"""
+        rot_from = segpos[self.from_seg][..., :3, :3]
+        rot_to = segpos[self.to_seg][..., :3, :3]
+        trace = np.einsum('...ij,...ij->...', rot_to, rot_from)
+        target = 0 if self.nfold == 1 else self.symangle
+        err = angle_error_lower_bound((trace - 1) / 2, target)
+        roterr = np.maximum(0, err - slack) / self.rot_tol
+        if (trans_slack is None or self.nfold == 1 or
+                self.origin_seg is not None): return roterr
+        x = relative_xform(segpos, self.from_seg, self.to_seg)
+        rot = x[..., :3, :3]
+        v = np.stack([rot[..., 2, 1] - rot[..., 1, 2],
+                      rot[..., 0, 2] - rot[..., 2, 0],
+                      rot[..., 1, 0] - rot[..., 0, 1]], axis=-1) / 2
+        dist = projection_lower_bound(x[..., :3, 3], v, slack, trans_slack)
+        return np.sqrt(roterr**2 + (dist / self.tol)**2)
+
     def alignment(self, segpos, **kwargs):
         if self.origin_seg is not None:
-            return inv(segpos[self.origin_seg])
+            return rigid_inv(segpos[self.origin_seg])
         x_from = segpos[self.from_seg]
         x_to = segpos[self.to_seg]
-        xhat = x_to @ inv(x_from)
+        xhat = x_to @ rigid_inv(x_from)
         axis, ang, cen = hm.axis_ang_cen_of(xhat)
         # print('aln', axis)
         # print('aln', ang * 180 / np.pi)
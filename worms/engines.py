@@ -0,0 +1,712 @@
+'search engines for grow other than the default cartesian enumeration'
+
+import numpy as np
+from xbin import XformBinner
+from .criteria import CriteriaList, WormCriteria
+from . import util
+
+
+def _children(criteria):
+    return criteria if isinstance(criteria, CriteriaList) else [criteria]
+
+
+def has_score_bound(criteria):
+    "True if any of criteria has a score_lower_bound"
+    return any(type(c).score_lower_bound is not WormCriteria.score_lower_bound
+               for c in _children(criteria))
+
+
+# rows of dense transforms made at a time from util.FactorizedXforms
+_BLOCK = 2**16
+
+
+def _xforms(x):
+    """x2orgn or x2exit as float64 for lookups by entry, compact
+    util.FactorizedXforms stay factorized"""
+    if isinstance(x, util.FactorizedXforms): return x.astype('f8')
+    return np.asarray(x, dtype='f8')
+
+
+def _blocks(x):
+    "start and dense rows of x2orgn or x2exit, _BLOCK rows at a time"
+    for lo in range(0, len(x), _BLOCK):
+        yield lo, np.asarray(x[lo:lo + _BLOCK], dtype='f8')
+
+
+def _rotation_angles(rots, refs):
+    "rotation angle between each of rots and the matching one of refs"
+    cosang = (np.einsum('...ij,...ij->...', rots, refs) - 1) / 2
+    return np.arccos(np.clip(cosang, -1, 1))
+
+
+class Reach:
+    """how far the x2orgn/x2exit of any entry of each segment can be from
+    those of a reference entry: rotation angles dorgn/dexit and
+    translations torgn/texit; lorgn/lexit are the largest translation of
+    any x2orgn/x2exit"""
+
+    def __init__(self, dorgn, dexit, torgn, texit, lorgn, lexit):
+        self.dorgn, self.dexit = np.asarray(dorgn), np.asarray(dexit)
+        self.torgn, self.texit = np.asarray(torgn), np.asarray(texit)
+        self.lorgn, self.lexit = np.asarray(lorgn), np.asarray(lexit)
+
+    def only(self, mask):
+        "same reach for segments in mask, none for the others"
+        return Reach(self.dorgn * mask, self.dexit * mask, self.torgn * mask,
+                     self.texit * mask, self.lorgn, self.lexit)
+
+    def __add__(self, other):
+        return Reach(self.dorgn + other.dorgn, self.dexit + other.dexit,
+                     self.torgn + other.torgn, self.texit + other.texit,
+                     np.maximum(self.lorgn, other.lorgn),
+                     np.maximum(self.lexit, other.lexit))
+
+    def slacks(self, criteria):
+        """per criteria, how far in radians the rotation and how far the
+        translation of relative_xform of any worm can be from those of the
+        reference worm
+
+        relative_xform is inv(x2orgn[lo]) @ x2exit[lo:hi] @ x2orgn[hi],
+        segments before lo cancel out. rotation differences of the factors
+        add up; translation differences too, plus each factor's rotation
+        difference times the translations of the factors after it"""
+        nseg = len(self.dorgn)
+        slacks = list()
+        for c in _children(criteria):
+            lo, hi = sorted((c.from_seg % nseg, c.to_seg % nseg))
+            drot = np.r_[self.dorgn[lo], self.dexit[lo:hi], self.dorgn[hi]]
+            dtrans = np.r_[self.torgn[lo] + self.dorgn[lo] * self.lorgn[lo],
+                           self.texit[lo:hi], self.torgn[hi]]
+            length = np.r_[self.lorgn[lo], self.lexit[lo:hi],
+                           self.lorgn[hi]]
+            before = np.cumsum(drot) - drot
+            # rounding, also in float32
+            slacks.append((np.sum(drot) + 1e-5,
+                           np.sum(dtrans + length * before) + 1e-3))
+        return slacks
+
+
+def entry_reach(segments, refs):
+    """Reach of each segment from entries refs[i] of segments[i], an
+    index per entry or one for all"""
+    nseg = len(segments)
+    reach = Reach(*np.zeros((6, nseg)))
+    for iseg, (seg, ref) in enumerate(zip(segments, refs)):
+        for name, drot, dtrans, length in (
+                ('x2orgn', reach.dorgn, reach.torgn, reach.lorgn),
+                ('x2exit', reach.dexit, reach.texit, reach.lexit)):
+            x = _xforms(getattr(seg, name))
+            ref = np.broadcast_to(ref, (len(x),))
+            for lo, blk in _blocks(x):
+                r = x[ref[lo:lo + len(blk)]]
+                drot[iseg] = max(drot[iseg], np.max(_rotation_angles(
+                    blk[:, :3, :3], r[:, :3, :3])))
+                dtrans[iseg] = max(dtrans[iseg], np.max(np.linalg.norm(
+                    blk[:, :3, 3] - r[:, :3, 3], axis=-1)))
+                length[iseg] = max(length[iseg], np.max(np.linalg.norm(
+                    blk[:, :3, 3], axis=-1)))
+    return reach
+
+
+def segment_reach(segments, isegs):
+    """reference entry of each segment and the Reach from it, none for
+    segments not in isegs"""
+    nseg = len(segments)
+    refidx = np.zeros(nseg, dtype='i8')
+    for iseg in isegs:
+        xs = [_xforms(segments[iseg].x2orgn), _xforms(segments[iseg].x2exit)]
+        # reference entry closest to the mean rotations
+        mean = [sum(blk[:, :3, :3].sum(0) for _, blk in _blocks(x)) / len(x)
+                for x in xs]
+        near = np.zeros(len(xs[0]))
+        for x, m in zip(xs, mean):
+            for lo, blk in _blocks(x):
+                near[lo:lo + len(blk)] += np.einsum('ij,nij->n', m,
+                                                    blk[:, :3, :3])
+        refidx[iseg] = np.argmax(near)
+    reach = entry_reach(segments, refidx)
+    return refidx, reach.only(np.isin(np.arange(nseg), list(isegs)))
+
+
+def _matchlast_ok(segments, matchlast, idx):
+    "body must match, and splice sites must be distinct"
+    a, b = segments[matchlast], segments[-1]
+    ia, ib = idx[:, matchlast], idx[:, -1]
+    return ((a.bodyid[ia] == b.bodyid[ib]) *
+            (a.entrysiteid[ia] != b.entrysiteid[ib]) *
+            (a.exitsiteid[ia] != b.entrysiteid[ib]))
+
+
+class _Bounds:
+    """score bounds for partial worms with segments[:depth] placed
+
+    unplaced segments take their reference entries, criteria whose
+    positions are all placed are scored exactly, the others give
+    score_lower_bound relaxed by the reach of the unplaced segments"""
+
+    def __init__(self, segments, criteria):
+        self.criteria = _children(criteria)
+        nseg = self.nseg = len(segments)
+        self.x2orgn = [_xforms(s.x2orgn) for s in segments]
+        self.x2exit = [_xforms(s.x2exit) for s in segments]
+        self.used = [c.positions_used(nseg) for c in self.criteria]
+        self.allused = set().union(*self.used)
+        refidx, reach = segment_reach(segments, range(nseg))
+        self.refidx = refidx
+        # refpos[d, j]: segment j of the reference completion after depth d
+        self.refpos = np.zeros((nseg + 1, nseg, 4, 4))
+        self.slacks = list()
+        for depth in range(nseg + 1):
+            xform = np.eye(4)
+            for j in range(depth, nseg):
+                self.refpos[depth, j] = xform @ self.x2orgn[j][refidx[j]]
+                xform = xform @ self.x2exit[j][refidx[j]]
+            self.slacks.append(reach.only(np.arange(nseg) >= depth).slacks(
+                criteria))
+
+    def complete(self, depth, conn, segpos):
+        """segpos with the unplaced segments at their reference entries,
+        conn the connection xforms after segments[depth - 1]"""
+        segpos = list(segpos)
+        for j in range(depth, self.nseg):
+            if j in self.allused: segpos[j] = conn @ self.refpos[depth, j]
+        return segpos
+
+    def estimate(self, depth, conn, segpos):
+        "score of the reference completion of each partial worm"
+        segpos = self.complete(depth, conn, segpos)
+        return sum(c.score(segpos=segpos) for c in self.criteria)
+
+    def __call__(self, depth, conn, segpos):
+        "lower bound on the score of any completion of each partial worm"
+        segpos = self.complete(depth, conn, segpos)
+        bound = np.zeros(len(conn))
+        for c, used, (slack, trans_slack) in zip(self.criteria, self.used,
+                                                 self.slacks[depth]):
+            if max(used) < depth:
+                bound = bound + c.score(segpos=segpos)
+            else:
+                bound = bound + c.score_lower_bound(
+                    segpos=segpos, slack=slack, trans_slack=trans_slack)
+        return bound
+
+
+def _expand(bounds, depth, idx, conn, segpos):
+    "every entry of segments[depth] appended to each partial worm"
+    nentry = len(bounds.x2orgn[depth])
+    iprev = np.repeat(np.arange(len(idx)), nentry)
+    ientry = np.tile(np.arange(nentry), len(idx))
+    idx = np.concatenate([idx[iprev], ientry[:, None]], axis=1)
+    segpos = [None if x is None else x[iprev] for x in segpos]
+    conn = conn[iprev]
+    if depth in bounds.allused:
+        segpos[depth] = conn @ bounds.x2orgn[depth][ientry]
+    conn = conn @ bounds.x2exit[depth][ientry]
+    return idx, conn, segpos
+
+
+def _select(keep, idx, conn, segpos):
+    return idx[keep], conn[keep], [None if x is None else x[keep]
+                                   for x in segpos]
+
+
+def _root(nseg):
+    "the empty partial worm"
+    return np.zeros((1, 0), dtype='i8'), np.eye(4)[None], [None] * nseg
+
+
+def dfs(segments, criteria, *, thresh, matchlast=None, max_results=10000,
+        memsize=1e6, **kw):
+    """depth first branch and bound, placing one segment at a time
+
+    partial worms go through the tree in batches of at most memsize / 64
+    children; a batch is dropped where _Bounds is >= thresh, or >= the
+    max_results-th best score once that many worms are found"""
+    bounds = _Bounds(segments, criteria)
+    nseg, maxbatch = len(segments), max(1, int(memsize / 64))
+    found_scores, found_idx = list(), list()
+    cutoff = thresh
+    stack = [(0,) + _root(nseg)]
+    while stack:
+        depth, idx, conn, segpos = stack.pop()
+        nentry = len(bounds.x2orgn[depth])
+        if len(idx) * nentry > maxbatch and len(idx) > 1:
+            half = len(idx) // 2
+            for part in (slice(half, None), slice(None, half)):
+                stack.append((depth,) + _select(part, idx, conn, segpos))
+            continue
+        idx, conn, segpos = _expand(bounds, depth, idx, conn, segpos)
+        depth += 1
+        bound = bounds(depth, conn, segpos)
+        ok = bound < cutoff
+        if depth == nseg and matchlast is not None:
+            ok &= _matchlast_ok(segments, matchlast, idx)
+        if not np.any(ok): continue
+        idx, conn, segpos = _select(ok, idx, conn, segpos)
+        bound = bound[ok]
+        if depth < nseg:
+            stack.append((depth, idx, conn, segpos))
+            continue
+        found_scores.append(bound)
+        found_idx.append(idx)
+        if sum(len(s) for s in found_scores) >= max_results:
+            scores = np.concatenate(found_scores)
+            order = np.argsort(scores)[:max_results]
+            found_scores = [scores[order]]
+            found_idx = [np.concatenate(found_idx)[order]]
+            cutoff = min(cutoff, scores[order[-1]])
+    if not found_scores: return None
+    scores, lowidx = np.concatenate(found_scores), np.concatenate(found_idx)
+    order = np.argsort(scores)[:max_results]
+    return scores[order], lowidx[order]
+
+
+def _beam_shard(context, depth, idx, conn, segpos):
+    """children of one shard of the beam, the beam_width best by
+    _Bounds.estimate that can still score < thresh; scores and indices of
+    finished worms < thresh if segments[depth] is the last one. context is
+    (bounds, segments, beam_width, thresh, matchlast) or the token of it
+    from util.resident_context"""
+    if isinstance(context, str):
+        context = util.worker_contexts[context]['context']
+    bounds, segments, beam_width, thresh, matchlast = context
+    idx, conn, segpos = _expand(bounds, depth, idx, conn, segpos)
+    depth += 1
+    if depth == len(segments):
+        score = bounds(depth, conn, segpos)  # exact, all placed
+        ok = score < thresh
+        if matchlast is not None:
+            ok &= _matchlast_ok(segments, matchlast, idx)
+        return score[ok], idx[ok]
+    ok = bounds(depth, conn, segpos) < thresh
+    idx, conn, segpos = _select(ok, idx, conn, segpos)
+    estimate = bounds.estimate(depth, conn, segpos)
+    best = np.argsort(estimate)[:beam_width]
+    return (estimate[best],) + _select(best, idx, conn, segpos)
+
+
+def beam(segments, criteria, *, thresh, matchlast=None, max_results=10000,
+         beam_width=1000, executor=None, executor_args=None, **kw):
+    """beam search, keeps the beam_width partial worms whose reference
+    completion scores best after each segment; shards of the beam are
+    expanded in parallel on executor, which gets the search data once per
+    worker where util.resident_context can, as grow does, then jobs send
+    only a token and their shard"""
+    bounds = _Bounds(segments, criteria)
+    nseg = len(segments)
+    executor = executor or util.InProcessExecutor
+    executor_args = dict(executor_args or {})
+    nshard = max(1, executor_args.get('max_workers') or 1)
+    context = (bounds, segments, beam_width, thresh, matchlast)
+    token, executor_args = util.resident_context(executor, executor_args,
+                                                 context)
+    idx, conn, segpos = _root(nseg)
+    try:
+        with executor(**executor_args) as pool:
+            for depth in range(nseg):
+                shards = np.array_split(np.arange(len(idx)),
+                                        min(nshard, len(idx)))
+                futures = [pool.submit(_beam_shard, token, depth,
+                                       *_select(s, idx, conn, segpos))
+                           for s in shards]
+                parts = [f.result() for f in futures]
+                if depth == nseg - 1: break
+                estimate = np.concatenate([p[0] for p in parts])
+                idx = np.concatenate([p[1] for p in parts])
+                conn = np.concatenate([p[2] for p in parts])
+                segpos = [None if parts[0][3][j] is None else
+                          np.concatenate([p[3][j] for p in parts])
+                          for j in range(nseg)]
+                if len(idx) == 0: return None
+                best = np.argsort(estimate)[:beam_width]
+                idx, conn, segpos = _select(best, idx, conn, segpos)
+    finally:
+        if token is not context: del util.worker_contexts[token]
+    scores = np.concatenate([p[0] for p in parts])
+    if len(scores) == 0: return None
+    lowidx = np.concatenate([p[1] for p in parts])
+    order = np.argsort(scores)[:max_results]
+    return scores[order], lowidx[order]
+
+
+def _fold_from(x2orgn, x2exit, idx, pos, conn, start):
+    """positions and connection xforms of segments start: for index rows
+    idx, in place, reusing those of the earlier segments"""
+    for j in range(start, len(x2orgn)):
+        prev = conn[:, j - 1] if j else np.eye(4)
+        pos[:, j] = prev @ x2orgn[j][idx[:, j]]
+        conn[:, j] = prev @ x2exit[j][idx[:, j]]
+
+
+def _neighbors(seg, keys, idx, maxshift, jump, rng):
+    """entries with the entry or exit residue of idx moved by up to maxshift,
+    same body and sites, or with probability jump any entry; idx where the
+    moved residue has no entry"""
+    n = len(idx)
+    shift = rng.randint(1, maxshift + 1, n) * rng.choice([-1, 1], n)
+    onexit = rng.rand(n) < 0.5
+    entryresid = seg.entryresid[idx] + np.where(onexit, 0, shift)
+    exitresid = seg.exitresid[idx] + np.where(onexit, shift, 0)
+    new = keys.lookup(seg.bodyid[idx], seg.entrysiteid[idx],
+                      seg.exitsiteid[idx], entryresid, exitresid)
+    new = np.where(new < 0, idx, new)
+    return np.where(rng.rand(n) < jump, rng.randint(len(seg), size=n), new)
+
+
+def anneal(segments, criteria, *, thresh, matchlast=None, max_results=10000,
+           seeds=None, nchain=1000, nstep=1000, temperature=1.0, maxshift=2,
+           jump=0.05, random_seed=None, **kw):
+    """simulated annealing over splice indices, many chains at once
+
+    chains start at seeds (index rows, e.g. Worms.indices) or random
+    worms; each step moves one segment of every chain to a neighboring
+    splice residue (_neighbors), refolds only that segment and the ones
+    after it, and accepts by the Metropolis rule at a temperature falling
+    linearly to zero (temperature=0 is greedy); every distinct worm
+    proposed or started from with score < thresh is returned, accepted
+    or not"""
+    rng = np.random.RandomState(random_seed)
+    nseg = len(segments)
+    x2orgn = [_xforms(s.x2orgn) for s in segments]
+    x2exit = [_xforms(s.x2exit) for s in segments]
+    keys = [util.KeyIndex(s.bodyid, s.entrysiteid, s.exitsiteid,
+                          s.entryresid, s.exitresid) for s in segments]
+    if seeds is None:
+        idx = np.stack([rng.randint(len(s), size=nchain) for s in segments],
+                       axis=1)
+    else:
+        idx = np.array(seeds, dtype='i8')
+    pos, conn = np.empty(idx.shape + (4, 4)), np.empty(idx.shape + (4, 4))
+    _fold_from(x2orgn, x2exit, idx, pos, conn, 0)
+
+    def score_of(idx, pos):
+        score = criteria.score(segpos=[pos[:, j] for j in range(nseg)])
+        if matchlast is not None:
+            score = np.where(_matchlast_ok(segments, matchlast, idx),
+                             score, np.inf)
+        return score
+
+    score = score_of(idx, pos)
+    found_scores, found_idx = [score[score < thresh]], [idx[score < thresh]]
+    # proposals are made in place, moved segments are restored on reject
+    oldpos, oldconn = np.empty_like(pos), np.empty_like(conn)
+    for step in range(nstep):
+        iseg = rng.randint(nseg)
+        oldidx = idx[:, iseg].copy()
+        oldpos[:, iseg:] = pos[:, iseg:]
+        oldconn[:, iseg:] = conn[:, iseg:]
+        idx[:, iseg] = _neighbors(segments[iseg], keys[iseg], oldidx,
+                                  maxshift, jump, rng)
+        _fold_from(x2orgn, x2exit, idx, pos, conn, iseg)
+        newscore = score_of(idx, pos)
+        low = newscore < thresh
+        found_scores.append(newscore[low])
+        found_idx.append(idx[low])
+        accept = newscore <= score
+        temp = temperature * (1 - step / nstep)
+        if temp > 0:
+            with np.errstate(over='ignore', invalid='ignore'):
+                prob = np.exp((score - newscore) / temp)
+            accept |= rng.rand(len(idx)) < prob
+        reject = ~accept
+        idx[reject, iseg] = oldidx[reject]
+        pos[reject, iseg:] = oldpos[reject, iseg:]
+        conn[reject, iseg:] = oldconn[reject, iseg:]
+        score[accept] = newscore[accept]
+    scores, lowidx = np.concatenate(found_scores), np.concatenate(found_idx)
+    if len(scores) == 0: return None
+    lowidx, first = np.unique(lowidx, axis=0, return_index=True)
+    scores = scores[first]
+    order = np.argsort(scores)[:max_results]
+    return scores[order], lowidx[order]
+
+
+class _Relaxed(WormCriteria):
+    """score_lower_bound of criteria for any worm whose relative_xform is
+    within slack and trans_slack of the one scored"""
+
+    def __init__(self, criteria, slack, trans_slack):
+        self.criteria = criteria
+        self.slack, self.trans_slack = slack, trans_slack
+        self.from_seg, self.to_seg = criteria.from_seg, criteria.to_seg
+        self.rigid_invariant = criteria.rigid_invariant
+
+    def score(self, segpos, **kw):
+        bound = self.criteria.score_lower_bound(
+            segpos=segpos, slack=self.slack, trans_slack=self.trans_slack)
+        return bound + np.zeros(segpos[self.to_seg].shape[:-2])
+
+    def score_lower_bound(self, segpos, slack=0, trans_slack=None, **kw):
+        # deviations from the representatives add to those given
+        if trans_slack is not None: trans_slack += self.trans_slack
+        return self.criteria.score_lower_bound(
+            segpos=segpos, slack=slack + self.slack, trans_slack=trans_slack)
+
+    def positions_used(self, nseg):
+        return self.criteria.positions_used(nseg)
+
+
+class Grouping:
+    """entries of each segment in groups, searched through one
+    representative entry per group and expanded to all members after
+
+    labels[i] has a label per entry of segments[i]; entries of a group
+    must share bodyid and splice sites, so matchlast holds for all members
+    or none. reach is the Reach of the members from their representative"""
+
+    def __init__(self, segments, labels):
+        self.segments = segments
+        self.reduced, self.members, self.groupof = list(), list(), list()
+        repof = list()
+        for seg, label in zip(segments, labels):
+            _, label = np.unique(label, axis=0, return_inverse=True)
+            label = label.reshape(-1)
+            order = np.argsort(label, kind='stable')
+            bounds = np.searchsorted(label[order], np.arange(label.max() + 2))
+            members = [order[lb:ub] for lb, ub in zip(bounds, bounds[1:])]
+            rep = np.array([m[len(m) // 2] for m in members])
+            self.reduced.append(seg.subset(rep))
+            self.members.append(members)
+            self.groupof.append(label)
+            repof.append(rep[label])
+        self.reach = entry_reach(segments, repof)
+
+    def sizes(self):
+        return [len(s.bodyid) for s in self.reduced]
+
+    def relaxed(self, criteria):
+        """criteria scoring worms of representatives no higher than any
+        worm of their members, by score_lower_bound with the
+        Reach.slacks of the members; 0 for criteria without a bound"""
+        return CriteriaList([
+            _Relaxed(c, slack, trans_slack) for c, (slack, trans_slack) in
+            zip(_children(criteria), self.reach.slacks(criteria))])
+
+    def expand(self, criteria, repidx, *, thresh, matchlast=None,
+               memsize=1e6):
+        """scores < thresh and index rows into the full segments of all
+        worms of members of the groups in representative index rows"""
+        nseg = len(self.segments)
+        x2orgn = [_xforms(s.x2orgn) for s in self.segments]
+        x2exit = [_xforms(s.x2exit) for s in self.segments]
+        maxbatch = max(1, int(memsize / 64))
+        found_scores, found_idx, batch = list(), list(), list()
+        for n, row in enumerate(repidx):
+            members = [self.members[j][row[j]] for j in range(nseg)]
+            grid = np.meshgrid(*members, indexing='ij')
+            batch.append(np.stack(grid, axis=-1).reshape(-1, nseg))
+            if n + 1 < len(repidx) and sum(map(len, batch)) < maxbatch:
+                continue
+            idx = np.concatenate(batch)
+            batch = list()
+            pos = np.empty(idx.shape + (4, 4))
+            conn = np.empty(idx.shape + (4, 4))
+            _fold_from(x2orgn, x2exit, idx, pos, conn, 0)
+            score = criteria.score(segpos=[pos[:, j] for j in range(nseg)])
+            ok = score < thresh
+            if matchlast is not None:
+                ok &= _matchlast_ok(self.segments, matchlast, idx)
+            found_scores.append(score[ok])
+            found_idx.append(idx[ok])
+        if not found_scores: return np.zeros(0), np.zeros((0, nseg), 'i8')
+        return np.concatenate(found_scores), np.concatenate(found_idx)
+
+
+def residue_blocks(seg, stride):
+    "labels grouping entries by body, sites and residues // stride"
+    return np.stack([seg.bodyid, seg.entrysiteid, seg.exitsiteid,
+                     np.asarray(seg.entryresid) // stride,
+                     np.asarray(seg.exitresid) // stride], axis=1)
+
+
+def transform_clusters(seg, cart_tol, ori_tol):
+    """labels clustering entries with the same body and sites whose x2orgn
+    and x2exit are within cart_tol and ori_tol radians of those of the
+    first entry of the cluster"""
+    xs = [_xforms(seg.x2orgn), _xforms(seg.x2exit)]
+    _, site = np.unique(np.stack([seg.bodyid, seg.entrysiteid,
+                                  seg.exitsiteid], axis=1),
+                        axis=0, return_inverse=True)
+    site = site.reshape(-1)
+    label = -np.ones(len(site), dtype='i8')
+    nlabel = 0
+    while True:
+        free = np.flatnonzero(label < 0)
+        if len(free) == 0: return label
+        lead = free[0]
+        cand = free[site[free] == site[lead]]
+        near = np.ones(len(cand), dtype='?')
+        for lo in range(0, len(cand), _BLOCK):
+            rows = cand[lo:lo + _BLOCK]
+            for x in xs:
+                cx, lx = x[rows], x[lead]
+                ok = _rotation_angles(cx[:, :3, :3], np.broadcast_to(
+                    lx[:3, :3], (len(rows), 3, 3))) <= ori_tol
+                ok &= np.linalg.norm(cx[:, :3, 3] - lx[:3, 3],
+                                     axis=1) <= cart_tol
+                near[lo:lo + len(rows)] &= ok
+        label[cand[near]] = nlabel
+        nlabel += 1
+
+
+def cluster_tolerances(criteria, cluster_tol):
+    """cart and ori tolerances for transform_clusters, cluster_tol times
+    the smallest tol and rot_tol of criteria"""
+    tols = [(c.tol, c.rot_tol) for c in _children(criteria)
+            if hasattr(c, 'tol')]
+    if not tols: return np.inf, np.inf
+    return tuple(cluster_tol * np.min(tols, axis=0))
+
+
+def hierarchical(segments, criteria, *, thresh, matchlast=None,
+                 max_results=10000, stride=3, coarse_thresh=None,
+                 memsize=1e6, **kw):
+    """coarse to fine search over splice residues
+
+    entries are grouped by residue_blocks, dfs finds the worms of group
+    representatives whose Grouping.relaxed score is < coarse_thresh
+    (default thresh, which misses no worm < thresh), then only the
+    members of those groups are scored"""
+    groups = Grouping(segments, [residue_blocks(s, stride)
+                                 for s in segments])
+    if coarse_thresh is None: coarse_thresh = thresh
+    ncoarse = int(np.prod(groups.sizes(), dtype='f8'))
+    coarse = dfs(groups.reduced, groups.relaxed(criteria),
+                 thresh=coarse_thresh, matchlast=matchlast,
+                 max_results=max(1, ncoarse), memsize=memsize)
+    if coarse is None: return None
+    scores, lowidx = groups.expand(criteria, coarse[1], thresh=thresh,
+                                   matchlast=matchlast, memsize=memsize)
+    if len(scores) == 0: return None
+    order = np.argsort(scores)[:max_results]
+    return scores[order], lowidx[order]
+
+
+def _state_keys(bounds, binner, depth, conn, segpos, rigid_invariant):
+    """bin index columns of what completions of partial worms with
+    segments[:depth] placed depend on: the connection xform and the placed
+    positions a criteria still needs, all relative to the first of those
+    if rigid_invariant"""
+    needed = sorted(set().union(*(
+        [j for j in used if j < depth] for used in bounds.used
+        if max(used) >= depth)))
+    xforms = [conn] + [segpos[j] for j in needed]
+    if rigid_invariant:
+        if not needed: return np.zeros((len(conn), 0), dtype='i8')
+        ref = util.rigid_inv(xforms.pop(1))
+        xforms = [ref @ x for x in xforms]
+    return np.stack([binner.get_bin_index(x) for x in xforms], axis=1)
+
+
+def _best_per_group(key, value, nkeep):
+    "indices of the nkeep lowest values among rows with equal key"
+    if key.shape[1] == 0: return np.argsort(value)[:nkeep]
+    _, group = np.unique(key, axis=0, return_inverse=True)
+    group = group.reshape(-1)
+    order = np.lexsort((value, group))
+    rank = np.arange(len(order)) - np.searchsorted(group[order],
+                                                   group[order])
+    return order[rank < nkeep]
+
+
+def _take(states, keep):
+    "rows keep of a tuple of per state arrays and lists of them"
+    return tuple([None if x is None else x[keep] for x in u]
+                 if isinstance(u, list) else u[keep] for u in states)
+
+
+def _concat(parts):
+    "tuples of per state arrays and lists of them, joined in order"
+    return tuple([None if x[0] is None else np.concatenate(x)
+                  for x in zip(*u)]
+                 if isinstance(u[0], list) else np.concatenate(u)
+                 for u in zip(*parts))
+
+
+def _best_states(key, estimate, nkeep, max_states):
+    """_best_per_group, then the max_states best of those; both keep the
+    same rows if applied to parts first, so states can be merged in
+    batches"""
+    keep = _best_per_group(key, estimate, nkeep)
+    if len(keep) > max_states:
+        keep = keep[np.argsort(estimate[keep])[:max_states]]
+    return keep
+
+
+def dp(segments, criteria, *, thresh, matchlast=None, max_results=10000,
+       nkeep=1, cart_resl=1.0, ori_resl=10.0, max_states=100000,
+       memsize=1e6, **kw):
+    """dynamic programming over binned transform states
+
+    after each segment partial worms are binned by XformBinner on
+    _state_keys, and by the body and sites at matchlast; only the nkeep
+    per bin with the best _Bounds.estimate are extended, and at most
+    max_states of those, so the states grow with the occupied transform
+    space instead of the product of segment sizes. states are extended in
+    batches of at most memsize / 64 children as in dfs, and the binned
+    table is merged whenever it holds twice max_states. finished worms are
+    rebuilt from backpointers"""
+    bounds = _Bounds(segments, criteria)
+    binner = XformBinner(cart_resl, ori_resl)
+    rigid = getattr(criteria, 'rigid_invariant', False)
+    nseg, maxbatch = len(segments), max(1, int(memsize / 64))
+    _, conn, segpos = _root(nseg)
+    mlentry = np.zeros(1, dtype='i8')
+    back = list()  # back[d]: parent state and entry of each state
+    for depth in range(nseg):
+        parent = np.arange(len(conn))[:, None]
+        step = max(1, maxbatch // len(bounds.x2orgn[depth]))
+        parts, nstate = list(), 0
+        for lb in range(0, len(conn), step):
+            batch = _select(slice(lb, lb + step), parent, conn, segpos)
+            ptr, bconn, bsegpos = _expand(bounds, depth, *batch)
+            ml = ptr[:, 1] if depth == matchlast else mlentry[ptr[:, 0]]
+            bound = bounds(depth + 1, bconn, bsegpos)
+            ok = bound < thresh
+            if depth + 1 == nseg:
+                parts.append((ptr[ok], bound[ok]))
+                continue
+            ptr, bconn, bsegpos = _select(ok, ptr, bconn, bsegpos)
+            ml = ml[ok]
+            key = _state_keys(bounds, binner, depth + 1, bconn, bsegpos,
+                              rigid)
+            if matchlast is not None and depth >= matchlast:
+                seg = segments[matchlast]
+                key = np.concatenate([key, np.stack([
+                    seg.bodyid[ml], seg.entrysiteid[ml],
+                    seg.exitsiteid[ml]], axis=1)], axis=1)
+            parts.append((ptr, bconn, bsegpos, ml, key,
+                          bounds.estimate(depth + 1, bconn, bsegpos)))
+            nstate += len(ptr)
+            if nstate > 2 * max_states or lb + step >= len(conn):
+                states = _concat(parts)
+                states = _take(states, _best_states(
+                    states[4], states[5], nkeep, max_states))
+                parts, nstate = [states], len(states[0])
+        states = _concat(parts)
+        ptr = states[0]
+        if depth + 1 < nseg: conn, segpos, mlentry = states[1:4]
+        back.append(ptr)
+        if len(ptr) == 0: return None
+    scores = states[1]
+    lowidx = np.zeros((len(scores), nseg), dtype='i8')
+    state = np.arange(len(scores))
+    for depth in reversed(range(nseg)):
+        lowidx[:, depth] = back[depth][state, 1]
+        state = back[depth][state, 0]
+    if matchlast is not None:
+        ok = _matchlast_ok(segments, matchlast, lowidx)
+        scores, lowidx = scores[ok], lowidx[ok]
+    if len(scores) == 0: return None
+    order = np.argsort(scores)[:max_results]
+    return scores[order], lowidx[order]
+
+
+ENGINES = dict(dfs=dfs, beam=beam, anneal=anneal, hierarchical=hierarchical,
+               dp=dp)
+
+
+def search(engine, segments, criteria, **kw):
+    """scores and indices of the best worms with score < thresh, sorted, or
+    None; segments should be pose-free Segments.geometry()"""
+    return ENGINES[engine](segments, criteria, **kw)
@@ -0,0 +1,185 @@
+'optional compiled kernels for search, used only if numba is installed'
+
+import numpy as np
+from .criteria import CriteriaList, Cyclic, AxesIntersect, NullCriteria
+try:
+    import numba
+    HAVE_NUMBA = True
+    jit = numba.njit(nogil=True, cache=True)
+except ImportError:
+    HAVE_NUMBA = False
+    jit = lambda f: f  # plain python, only sensible for tiny inputs
+
+NULL, CYCLIC, AXES = 0, 1, 2
+
+
+def encode_criteria(criteria, nseg):
+    """criteria as a (ncrit, 7) parameter array for chunk_kernel
+
+    rows are kind, from_seg, to_seg, tol, rot_tol, angle, nfold; returns
+    None if any criteria has no compiled scoring"""
+    if not isinstance(criteria, CriteriaList):
+        criteria = CriteriaList(criteria)
+    params = []
+    for c in criteria:
+        if isinstance(c, NullCriteria):
+            params.append((NULL, 0, 0, 1, 1, 0, 0))
+        elif isinstance(c, Cyclic) and c.origin_seg is None:
+            params.append((CYCLIC, c.from_seg % nseg, c.to_seg % nseg,
+                           c.tol, c.rot_tol, c.symangle, c.nfold))
+        elif isinstance(c, AxesIntersect) and not c.distinct_axes:
+            params.append((AXES, c.from_seg % nseg, c.to_seg % nseg,
+                           c.tol, c.rot_tol, c.angle, 0))
+        else:
+            return None
+    return np.array(params, dtype='f8')
+
+
+def prefix_tables(segments):
+    "stacked x2orgn/x2exit rows, offsets and sizes of chunk prefix segments"
+    sizes = np.array([len(s) for s in segments], dtype='i8')
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype('i8')
+    x2orgn = np.concatenate([np.asarray(s.x2orgn, dtype='f8')
+                             for s in segments])
+    x2exit = np.concatenate([np.asarray(s.x2exit, dtype='f8')
+                             for s in segments])
+    return x2orgn, x2exit, offsets, sizes
+
+
+@jit
+def _matmul44(a, b, out):
+    for i in range(4):
+        for j in range(4):
+            out[i, j] = (a[i, 0] * b[0, j] + a[i, 1] * b[1, j] +
+                         a[i, 2] * b[2, j] + a[i, 3] * b[3, j])
+
+
+@jit
+def _score_cyclic(x_from, x_to, tol, rot_tol, symangle, nfold):
+    # xhat = x_to @ inv(x_from), x_from rigid; rotation part r, translation t
+    r00 = (x_to[0, 0] * x_from[0, 0] + x_to[0, 1] * x_from[0, 1] +
+           x_to[0, 2] * x_from[0, 2])
+    r01 = (x_to[0, 0] * x_from[1, 0] + x_to[0, 1] * x_from[1, 1] +
+           x_to[0, 2] * x_from[1, 2])
+    r02 = (x_to[0, 0] * x_from[2, 0] + x_to[0, 1] * x_from[2, 1] +
+           x_to[0, 2] * x_from[2, 2])
+    r10 = (x_to[1, 0] * x_from[0, 0] + x_to[1, 1] * x_from[0, 1] +
+           x_to[1, 2] * x_from[0, 2])
+    r11 = (x_to[1, 0] * x_from[1, 0] + x_to[1, 1] * x_from[1, 1] +
+           x_to[1, 2] * x_from[1, 2])
+    r12 = (x_to[1, 0] * x_from[2, 0] + x_to[1, 1] * x_from[2, 1] +
+           x_to[1, 2] * x_from[2, 2])
+    r20 = (x_to[2, 0] * x_from[0, 0] + x_to[2, 1] * x_from[0, 1] +
+           x_to[2, 2] * x_from[0, 2])
+    r21 = (x_to[2, 0] * x_from[1, 0] + x_to[2, 1] * x_from[1, 1] +
+           x_to[2, 2] * x_from[1, 2])
+    r22 = (x_to[2, 0] * x_from[2, 0] + x_to[2, 1] * x_from[2, 1] +
+           x_to[2, 2] * x_from[2, 2])
+    f0, f1, f2 = x_from[0, 3], x_from[1, 3], x_from[2, 3]
+    t0 = x_to[0, 3] - (r00 * f0 + r01 * f1 + r02 * f2)
+    t1 = x_to[1, 3] - (r10 * f0 + r11 * f1 + r12 * f2)
+    t2 = x_to[2, 3] - (r20 * f0 + r21 * f1 + r22 * f2)
+    ax0 = r21 - r12
+    ax1 = r02 - r20
+    ax2 = r10 - r01
+    four_sin2 = ax0 * ax0 + ax1 * ax1 + ax2 * ax2
+    sin_angl = min(1.0, max(-1.0, np.sqrt(four_sin2 / 4)))
+    cos_angl = min(1.0, max(-1.0, (r00 + r11 + r22 + 1.0) / 2 - 1))
+    angle = np.arctan2(sin_angl, cos_angl)
+    if nfold == 1:
+        carterrsq = t0**2 + t1**2 + t2**2
+        roterrsq = angle**2
+    else:
+        if four_sin2 == 0:
+            return np.nan  # no axis, as the numpy scoring gives
+        dot = (t0 * ax0 + t1 * ax1 + t2 * ax2) / np.sqrt(four_sin2)
+        carterrsq = dot**2
+        roterrsq = (angle - symangle)**2
+    return np.sqrt(carterrsq / tol**2 + roterrsq / rot_tol**2)
+
+
+@jit
+def _score_axes(x_from, x_to, tol, rot_tol, tgtangle):
+    # same as AxesIntersect.score with distinct_axes=False
+    d0 = x_to[0, 3] - x_from[0, 3]
+    d1 = x_to[1, 3] - x_from[1, 3]
+    d2 = x_to[2, 3] - x_from[2, 3]
+    a0, a1, a2 = x_from[0, 2], x_from[1, 2], x_from[2, 2]
+    b0, b1, b2 = x_to[0, 2], x_to[1, 2], x_to[2, 2]
+    c0, c1, c2 = a1 * b2 - a2 * b1, a2 * b0 - a0 * b2, a0 * b1 - a1 * b0
+    dotab = a0 * b0 + a1 * b1 + a2 * b2
+    if abs(dotab) > 0.9999:
+        proj = (a0 * d0 + a1 * d1 + a2 * d2) / (a0 * a0 + a1 * a1 + a2 * a2)
+        p0, p1, p2 = d0 - proj * a0, d1 - proj * a1, d2 - proj * a2
+        dist = np.sqrt(p0 * p0 + p1 * p1 + p2 * p2)
+    else:
+        d = np.sqrt(c0 * c0 + c1 * c1 + c2 * c2)
+        dist = 0.0
+        if abs(d) > 0.00001:
+            dist = abs(d0 * c0 + d1 * c1 + d2 * c2) / d
+    ang = np.arccos(abs(dotab))
+    return np.sqrt((ang - tgtangle)**2 / rot_tol**2 + (dist / tol)**2)
+
+
+@jit
+def chunk_kernel(x2orgn, x2exit, offsets, nprefix, tail_orgn, tail_exit,
+                 crit, mlseg, mlallowed, thresh, out_score, out_idx):
+    """score every worm in a chunk, fused with the chaining
+
+    prefix segment i has rows offsets[i]:offsets[i] + nprefix[i] of x2orgn and
+    x2exit; tail_orgn/tail_exit are the sampled rows of the tail segments.
+    positions are built incrementally in C order over the prefix indices,
+    worms with score < thresh have score and flat prefix index written to
+    out_score/out_idx, returns how many"""
+    end = len(nprefix)
+    ntail = len(tail_orgn)
+    nseg = end + ntail
+    conn = np.zeros((end + ntail, 4, 4))
+    pos = np.zeros((nseg, 4, 4))
+    digit = np.zeros(end, dtype=np.int64)
+    total = 1
+    for i in range(end):
+        total *= nprefix[i]
+    nout = 0
+    dirty = 0  # first prefix level whose positions are out of date
+    for flat in range(total):
+        if flat > 0:
+            k = end - 1
+            digit[k] += 1
+            while digit[k] == nprefix[k]:
+                digit[k] = 0
+                k -= 1
+                digit[k] += 1
+            dirty = min(dirty, k)
+        if mlseg >= 0 and not mlallowed[digit[mlseg]]:
+            continue
+        for i in range(dirty, end):
+            row = offsets[i] + digit[i]
+            if i == 0:
+                pos[0] = x2orgn[row]
+                conn[0] = x2exit[row]
+            else:
+                _matmul44(conn[i - 1], x2orgn[row], pos[i])
+                _matmul44(conn[i - 1], x2exit[row], conn[i])
+        for j in range(ntail):
+            i = end + j
+            _matmul44(conn[i - 1], tail_orgn[j], pos[i])
+            if j + 1 < ntail:
+                _matmul44(conn[i - 1], tail_exit[j], conn[i])
+        dirty = end
+        score = 0.0
+        for c in range(len(crit)):
+            kind = int(crit[c, 0])
+            if kind == CYCLIC:
+                score += _score_cyclic(pos[int(crit[c, 1])],
+                                       pos[int(crit[c, 2])], crit[c, 3],
+                                       crit[c, 4], crit[c, 5], crit[c, 6])
+            elif kind == AXES:
+                score += _score_axes(pos[int(crit[c, 1])],
+                                     pos[int(crit[c, 2])], crit[c, 3],
+                                     crit[c, 4], crit[c, 5])
+        if score < thresh:
+            out_score[nout] = score
+            out_idx[nout] = flat
+            nout += 1
+    return nout
@@ -2,16 +2,20 @@
 
 import sys
 import os
+import copy
 import pickle
+import threading
 import itertools as it
 import numpy as np
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from xbin import XformBinner
-from homog import hinv, hrot
-from concurrent.futures import ProcessPoolExecutor
+from homog import hrot
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from .worms import Segment, Segments, Worms
 from .criteria import CriteriaList, Cyclic, WormCriteria
 from . import util
+from . import kernels
+from . import engines
 # import numba
 
 
@@ -79,7 +83,7 @@ class MakeXIndexAccumulator:
         positions = np.concatenate([x[2] for x in self.tmp])[sc <= self.thresh]
         from_pos = positions[:, self.from_seg]
         to_pos = positions[:, self.to_seg]
-        xtgt = hinv(from_pos) @ to_pos
+        xtgt = util.rigid_inv(from_pos) @ to_pos
         bin_idx = self.binner.get_bin_index(xtgt)
 
         for k, v in zip(bin_idx, indices):
@@ -118,10 +122,13 @@ class MakeXIndexAccumulator:
 # return 999999.
 
 
-class XIndexedCriteria(WormCriteria):
+class XIndexedCriteria(WormCriteria, util.SharedArraysMixin):
+
+    _array_names = ('xindex_keys',)
 
     def __init__(self, xindex, binner, nfold, from_seg=-1):
-        self.xindex_set = set(xindex.keys())
+        self.xindex_keys = np.sort(np.fromiter(xindex.keys(), dtype='i8',
+                                               count=len(xindex)))
         self.binner = binner
         self.from_seg = from_seg
         self.cyclic_xform = hrot([0, 0, 1], 360 / nfold)
@@ -129,14 +136,15 @@ class XIndexedCriteria(WormCriteria):
         # GLOBAL_xindex_set = self.xindex_set
 
     def get_xform_commutator(self, from_pos, to_pos):
-        return np.linalg.inv(from_pos) @ to_pos
+        return util.rigid_inv(from_pos) @ to_pos
 
     def is_in_xindex_set(self, idxary):
-        is_in = np.ones(idxary.size, dtype='f') * 999999.
-        for i, idx in enumerate(idxary.flat):
-            if idx in self.xindex_set:
-                is_in[i] = 0
-        return is_in.reshape(idxary.shape)
+        keys = self.xindex_keys
+        if len(keys) == 0:
+            return np.full(idxary.shape, 999999., dtype='f')
+        pos = np.searchsorted(keys, idxary)
+        found = keys[np.minimum(pos, len(keys) - 1)] == idxary
+        return np.where(found, 0, 999999.).astype('f')
 
     def score(self, segpos, **kw):
         from_pos = segpos[self.from_seg]
@@ -145,6 +153,9 @@ class XIndexedCriteria(WormCriteria):
         bin_idx = self.binner.get_bin_index(xtgt)
         return self.is_in_xindex_set(bin_idx)
 
+    def positions_used(self, nseg):
+        return {self.from_seg % nseg}
+
     def alignment(self, segpos, **kw):
         return np.eye(4)
 
@@ -186,7 +197,7 @@ class XIndexedAccumulator:
         lowidx = lowidx[:self.max_results]
         from_pos = lowpos[:, -1]
         to_pos = self.cyclic_xform @ from_pos
-        xtgt = hinv(from_pos) @ to_pos
+        xtgt = util.rigid_inv(from_pos) @ to_pos
         bin_idx = self.binner.get_bin_index(xtgt)
 
         # head_idx = np.stack([self.xindex[i] for i in bin_idx])
@@ -250,10 +261,34 @@ class XIndexedAccumulator:
 
 
 def _get_chunk_end_seg(sizes, max_workers, memsize):
+    """returns end, tile: chunks are every combination of segments[:end],
+    except if tile is not None only tile entries of segments[end - 1] go in
+    each chunk, so one big segment can't blow up or shrink the chunks"""
     end = len(sizes) - 1
     while end > 1 and (util.bigprod(sizes[end:]) < max_workers or
                        memsize <= 64 * util.bigprod(sizes[:end])): end -= 1
-    return end
+    if memsize <= 64 * util.bigprod(sizes[:end]):
+        iseg = end - 1  # even the smallest prefix is too big
+    elif end < len(sizes) - 1:
+        iseg = end  # fill up the chunk with part of the next segment
+    else:
+        return end, None
+    tile = max(1, int(memsize / 64 / util.bigprod(sizes[:iseg])))
+    ntile = -(-sizes[iseg] // tile)
+    if tile < 2 and iseg == end or not 1 < ntile:
+        return end, None
+    if ntile * util.bigprod(sizes[iseg + 1:]) < max_workers:
+        return end, None
+    return iseg + 1, tile
+
+
+def _chunk_counts(sizes, end, tile):
+    "worms per chunk and number of chunks for _get_chunk_end_seg output"
+    if tile is None:
+        return util.bigprod(sizes[:end]), util.bigprod(sizes[end:])
+    ntile = -(-sizes[end - 1] // tile)
+    return (util.bigprod(sizes[:end - 1]) * tile,
+            ntile * util.bigprod(sizes[end:]))
 
 
 def grow(
@@ -272,8 +307,27 @@ def grow(
     max_results=int(1e4),
     cart_resl=2.0,
     ori_resl=15.0,
-    xindex_cache_file=None
+    xindex_cache_file=None,
+    precision='f8',
+    backend='numpy',
+    engine='enumerate',
+    engine_args=None,
+    beam_width=1000,
+    cluster_tol=None
 ):
+    """precision: 'f4' searches with float32 transforms, survivors are
+    refolded and rescored in float64 before results are reported
+    backend: 'numba' scores chunks with the compiled kernels.chunk_kernel
+    if numba is installed and the criteria are supported, else numpy
+    engine: 'enumerate' scores every worm (or every_other one), else one of
+    engines.ENGINES, called with engine_args
+    beam_width: partial worms kept per segment by engine='beam'
+    cluster_tol: if given, entries of each segment with the same body and
+    sites are clustered by transform, within cluster_tol times the
+    criteria tol and rot_tol (engines.transform_clusters); the search runs
+    on cluster representatives scored by Grouping.relaxed, which is no
+    higher than the score of any member, and the members of every
+    representative worm < thresh are rescored"""
     if True:  # setup
         os.environ['OMP_NUM_THREADS'] = '1'
         os.environ['MKL_NUM_THREADS'] = '1'
@@ -296,6 +350,22 @@ def grow(
             __print_best = True
         if not isinstance(criteria, CriteriaList):
             criteria = CriteriaList(criteria)
+        if precision not in ('f4', 'f8'):
+            raise ValueError("precision must be 'f4' or 'f8', not " +
+                             repr(precision))
+        if backend not in ('numpy', 'numba'):
+            raise ValueError("backend must be 'numpy' or 'numba', not " +
+                             repr(backend))
+        if engine != 'enumerate' and engine not in engines.ENGINES:
+            raise ValueError('unknown engine: ' + repr(engine))
+        if engine != 'enumerate' and criteria.origin_seg is not None:
+            raise ValueError('engine ' + repr(engine) +
+                             ' does not support origin_seg')
+        if cluster_tol is not None and criteria.origin_seg is not None:
+            raise ValueError('cluster_tol does not support origin_seg')
+        if engine != 'enumerate' and precision != 'f8':
+            raise ValueError('engine ' + repr(engine) +
+                             " only supports precision='f8'")
         if max_workers is not None and max_workers <= 0:
             max_workers = util.cpu_count()
         if executor_args is None and max_workers is None:
@@ -314,52 +384,98 @@ def grow(
     if criteria.origin_seg is None:
 
         matchlast = _check_topology(segments, criteria, expert)
+        full_segments, full_criteria = segments, criteria
+        lo, hi = _rigid_invariant_span(segments, criteria, matchlast)
+        free_choices = None
+        if (lo, hi) != (0, len(segments) - 1):
+            # prefix/suffix segments can't change the score, search lo..hi
+            segments = segments[lo:hi + 1]
+            criteria = _shift_criteria(criteria, lo, len(full_segments))
+            if matchlast is not None:
+                matchlast = matchlast % len(full_segments) - lo
+            if engine_args and engine_args.get('seeds') is not None:
+                seeds = np.asarray(engine_args['seeds'])
+                # results keep the free segment choices of the seeds
+                free_choices = np.unique(np.delete(
+                    seeds, np.arange(lo, hi + 1), axis=1), axis=0)
+                engine_args = dict(engine_args, seeds=seeds[:, lo:hi + 1])
+            if verbosity >= 0:
+                print('rigid invariant criteria, searching segments',
+                      lo, 'to', hi)
         sizes = [len(s) for s in segments]
-        end = _get_chunk_end_seg(sizes, max_workers, memsize)
-        ntot, chunksize, nchunks = (util.bigprod(x)
-                                    for x in (sizes, sizes[:end], sizes[end:]))
-        if max_samples is not None:
-            max_samples = np.clip(chunksize * max_workers, max_samples, ntot)
-        every_other = max(1, int(ntot / max_samples)) if max_samples else 1
-        njob = int(np.sqrt(nchunks / every_other) / 32) * nworker
-        njob = np.clip(nworker, njob, nchunks)
-
-        actual_ntot = int(ntot / every_other)
-        actual_nchunk = int(nchunks / every_other)
-        actual_perjob = int(ntot / every_other / njob)
-        actual_chunkperjob = int(nchunks / every_other / njob)
-        if verbosity >= 0:
-            print('tot: {:,} chunksize: {:,} nchunks: {:,} nworker: {} njob: {}'.format(
-                ntot, chunksize, nchunks, nworker, njob))
-            print('worm/job: {:,} chunk/job: {} sizes={} every_other={}'.format(
-                int(ntot / njob), int(nchunks / njob), sizes, every_other))
-            print('max_samples: {:,} max_results: {:,}'.format(
-                max_samples, max_results))
-            print('actual tot:        {:,}'.format(int(actual_ntot)))
-            print('actual nchunks:    {:,}'.format(int(actual_nchunk)))
-            print('actual worms/job:  {:,}'.format(int(actual_perjob)))
-            print('actual chunks/job: {:,}'.format(int(actual_chunkperjob)))
-        _grow_args = dict(executor=executor, executor_args=executor_args,
-                          njob=njob, end=end, thresh=thresh,
-                          matchlast=matchlast, every_other=every_other,
-                          max_results=max_results, nworker=nworker,
-                          verbosity=verbosity)
-        if njob > 1e9 or nchunks >= 2**63 or every_other >= 2**63:
-            print('too big?!?')
-            print('    njob', njob)
-            print('    nchunks', nchunks, nchunks / 2**63)
-            print('    every_other', every_other, every_other / 2**63)
-            raise ValueError('system too big')
-        accum = SimpleAccumulator(max_results=max_results, max_tmp_size=1e5)
-        _grow(segments, criteria, accum, **_grow_args)
-        result = accum.final_result()
+        search_segments, search_criteria, groups = segments, criteria, None
+        search_max_results = max_results
+        if cluster_tol is not None:
+            geom = Segments(segments).geometry()
+            tols = engines.cluster_tolerances(criteria, cluster_tol)
+            groups = engines.Grouping(geom, [
+                engines.transform_clusters(s, *tols) for s in geom])
+            search_segments = Segments(groups.reduced)
+            search_criteria = groups.relaxed(criteria)
+            # the best members may be in any representative worm
+            search_max_results = max(1, int(util.bigprod(groups.sizes())))
+            if engine_args and engine_args.get('seeds') is not None:
+                seeds = np.asarray(engine_args['seeds'])
+                seeds = np.stack([g[seeds[:, j]] for j, g in
+                                  enumerate(groups.groupof)], axis=1)
+                engine_args = dict(engine_args, seeds=seeds)
+            if verbosity >= 0:
+                print('clustered segment sizes', groups.sizes())
+        if engine == 'enumerate':
+            result, detail = _grow_enumerate(
+                search_segments, search_criteria, groups.sizes() if groups
+                else sizes, thresh=thresh, matchlast=matchlast,
+                max_results=search_max_results, max_samples=max_samples,
+                # same memory budget holds more float32 chunk positions
+                memsize=memsize * 8 / np.dtype(precision).itemsize,
+                executor=executor,
+                executor_args=executor_args, max_workers=max_workers,
+                nworker=nworker, verbosity=verbosity, precision=precision,
+                backend=backend)
+        else:
+            result = engines.search(
+                engine, Segments(search_segments).geometry(),
+                search_criteria, thresh=thresh, matchlast=matchlast,
+                max_results=search_max_results,
+                memsize=memsize, executor=executor,
+                executor_args=executor_args, verbosity=verbosity,
+                **dict(dict(beam_width=beam_width), **(engine_args or {})))
+            if result is not None:
+                result = result + (_refold_segments(
+                    search_segments, result[1], dtype='f8'),)
+            detail = dict(engine=engine, sizes=sizes,
+                          ntot=util.bigprod(sizes))
         if result is None: return None
         scores, lowidx, lowpos = result
+        if groups is not None:
+            scores, lowidx = groups.expand(
+                criteria, lowidx, thresh=thresh, matchlast=matchlast,
+                memsize=memsize)
+            order = np.argsort(scores)[:max_results]
+            if len(order) == 0: return None
+            scores, lowidx = scores[order], lowidx[order]
+            lowpos = _refold_segments(segments, lowidx, dtype='f8')
+            detail.update(sizes=sizes, clustered_sizes=groups.sizes())
+        elif precision != 'f8' and engine == 'enumerate':
+            # rescore survivors in full precision
+            lowpos = _refold_segments(segments, lowidx, dtype='f8')
+            scores = criteria.score(segpos=[lowpos[:, i] for i in
+                                            range(len(segments))])
+            order = np.argsort(scores)
+            order = order[scores[order] < thresh]
+            scores, lowidx, lowpos = (scores[order], lowidx[order],
+                                      lowpos[order])
+            if len(scores) == 0: return None
+        nfree = 1
+        if segments is not full_segments:
+            segments, criteria = full_segments, full_criteria
+            scores, lowidx, nfree = _expand_free_segments(
+                segments, lo, hi, scores, lowidx, max_results, free_choices)
+            lowpos = _refold_segments(segments, lowidx, dtype='f8')
         lowposlist = [lowpos[:, i] for i in range(len(segments))]
         score_check = criteria.score(segpos=lowposlist, verbosity=verbosity)
         assert np.allclose(score_check, scores)
-        detail = dict(ntot=ntot, chunksize=chunksize, nchunks=nchunks,
-                      nworker=nworker, njob=njob, sizes=sizes, end=end)
+        detail.update(search_span=(lo, hi), nfree=nfree)
 
     else:  # hash-based protocol...
 
@@ -373,20 +489,22 @@ def grow(
         print('    full:', [len(s) for s in segments])
 
         headsizes = [len(s) for s in head]
-        headend = _get_chunk_end_seg(headsizes, max_workers, memsize)
-        ntot, chunksize, nchunks = (util.bigprod(x)
-                                    for x in (headsizes, headsizes[:headend],
-                                              headsizes[headend:]))
+        headend, headtile = _get_chunk_end_seg(headsizes, max_workers,
+                                               memsize)
+        ntot = util.bigprod(headsizes)
+        chunksize, nchunks = _chunk_counts(headsizes, headend, headtile)
         if max_samples is not None:
             max_samples = np.clip(chunksize * max_workers, max_samples, ntot)
         every_other = max(1, int(ntot / max_samples)) if max_samples else 1
         njob = int(np.sqrt(nchunks / every_other) / 8 / nworker) * nworker
         njob = np.clip(nworker, njob, nchunks)
         _grow_args = dict(executor=executor, executor_args=executor_args,
-                          njob=njob, end=headend, thresh=thresh,
+                          njob=njob, end=headend, tile=headtile,
+                          thresh=thresh,
                           matchlast=0, every_other=every_other,
                           max_results=max_results, nworker=nworker,
-                          verbosity=verbosity)
+                          verbosity=verbosity, precision=precision,
+            backend=backend, memsize=memsize)
         t1 = 0
         if xindex_cache_file and os.path.exists(xindex_cache_file):
             print('!' * 100)
@@ -445,10 +563,10 @@ def grow(
                                      max_results=max_results * 20)
 
         tailsizes = [len(s) for s in tail]
-        tailend = _get_chunk_end_seg(tailsizes, max_workers, memsize)
-        ntot, chunksize, nchunks = (util.bigprod(x)
-                                    for x in (tailsizes, tailsizes[:tailend],
-                                              tailsizes[tailend:]))
+        tailend, tailtile = _get_chunk_end_seg(tailsizes, max_workers,
+                                               memsize)
+        ntot = util.bigprod(tailsizes)
+        chunksize, nchunks = _chunk_counts(tailsizes, tailend, tailtile)
         if max_samples is not None:
             max_samples = np.clip(chunksize * max_workers, max_samples, ntot)
         every_other = max(1, int(ntot / max_samples * 20)
@@ -459,10 +577,11 @@ def grow(
         _grow_args = dict(
             executor=executor,
             executor_args=executor_args,
-            njob=njob, end=tailend, thresh=thresh,
+            njob=njob, end=tailend, tile=tailtile, thresh=thresh,
             matchlast=None, every_other=every_other,
             max_results=max_results, nworker=nworker,
-            verbosity=verbosity)
+            verbosity=verbosity, precision=precision,
+            backend=backend, memsize=memsize)
 
         print('STEP TWO: using xindex, nentries {:,}'.format(len(xindex)))
         print('    ntot            {:,}'.format(ntot))
@@ -520,13 +639,73 @@ def grow(
         lowpos = lowpos[order]
         lowidx = lowidx[order]
         detail = dict(ntot=ntot, chunksize=chunksize, nchunks=nchunks,
-                      nworker=nworker, njob=njob, sizes=tailsizes, end=tailend)
+                      nworker=nworker, njob=njob, sizes=tailsizes, end=tailend,
+                      tile=tailtile)
 
     return Worms(segments, scores, lowidx, lowpos, criteria, detail)
 
 
-def _refold_segments(segments, lowidx):
-    pos = np.zeros_like(lowidx, dtype='(4,4)f') + np.eye(4)
+def refine(worms, *, thresh=2, expert=0, verbosity=0, **engine_args):
+    """worms near those in worms by local search, a new Worms or None;
+    engine_args go to engines.anneal, seeded with worms.indices. if grow
+    searches only the rigid invariant span, segments outside it keep the
+    choices made in worms"""
+    engine_args = dict(engine_args, seeds=worms.indices)
+    return grow(worms.segments, worms.criteria, thresh=thresh, expert=expert,
+                verbosity=verbosity, engine='anneal', engine_args=engine_args)
+
+
+def _grow_enumerate(segments, criteria, sizes, *, thresh, matchlast,
+                    max_results, max_samples, memsize, executor,
+                    executor_args, max_workers, nworker, verbosity,
+                    precision, backend):
+    "cartesian enumeration for grow, in chunks spread over the executor"
+    end, tile = _get_chunk_end_seg(sizes, max_workers, memsize)
+    ntot = util.bigprod(sizes)
+    chunksize, nchunks = _chunk_counts(sizes, end, tile)
+    if max_samples is not None:
+        max_samples = np.clip(chunksize * max_workers, max_samples, ntot)
+    every_other = max(1, int(ntot / max_samples)) if max_samples else 1
+    njob = int(np.sqrt(nchunks / every_other) / 32) * nworker
+    njob = np.clip(nworker, njob, nchunks)
+
+    actual_ntot = int(ntot / every_other)
+    actual_nchunk = int(nchunks / every_other)
+    actual_perjob = int(ntot / every_other / njob)
+    actual_chunkperjob = int(nchunks / every_other / njob)
+    if verbosity >= 0:
+        print('tot: {:,} chunksize: {:,} nchunks: {:,} nworker: {} '
+              'njob: {}'.format(ntot, chunksize, nchunks, nworker, njob))
+        print('worm/job: {:,} chunk/job: {} sizes={} every_other={}'.format(
+            int(ntot / njob), int(nchunks / njob), sizes, every_other))
+        print('max_samples: {:,} max_results: {:,}'.format(
+            max_samples, max_results))
+        print('actual tot:        {:,}'.format(int(actual_ntot)))
+        print('actual nchunks:    {:,}'.format(int(actual_nchunk)))
+        print('actual worms/job:  {:,}'.format(int(actual_perjob)))
+        print('actual chunks/job: {:,}'.format(int(actual_chunkperjob)))
+    _grow_args = dict(executor=executor, executor_args=executor_args,
+                      njob=njob, end=end, tile=tile, thresh=thresh,
+                      matchlast=matchlast, every_other=every_other,
+                      max_results=max_results, nworker=nworker,
+                      verbosity=verbosity, precision=precision,
+                      backend=backend, memsize=memsize)
+    if njob > 1e9 or nchunks >= 2**63 or every_other >= 2**63:
+        print('too big?!?')
+        print('    njob', njob)
+        print('    nchunks', nchunks, nchunks / 2**63)
+        print('    every_other', every_other, every_other / 2**63)
+        raise ValueError('system too big')
+    accum = SimpleAccumulator(max_results=max_results, max_tmp_size=1e5)
+    _grow(segments, criteria, accum, **_grow_args)
+    result = accum.final_result()
+    detail = dict(ntot=ntot, chunksize=chunksize, nchunks=nchunks,
+                  nworker=nworker, njob=njob, sizes=sizes, end=end, tile=tile)
+    return result, detail
+
+
+def _refold_segments(segments, lowidx, dtype='f4'):
+    pos = np.zeros(lowidx.shape + (4, 4), dtype=dtype) + np.eye(4)
     end = np.eye(4)
     for i, seg in enumerate(segments):
         pos[:, i] = end @ seg.x2orgn[lowidx[:, i]]
@@ -534,18 +713,75 @@ def _refold_segments(segments, lowidx):
     return pos
 
 
-def _chain_xforms(segments):
-    x2exit = [s.x2exit for s in segments]
-    x2orgn = [s.x2orgn for s in segments]
+def _rigid_invariant_span(segments, criteria, matchlast):
+    """first and last segment the score can depend on
+
+    segments before from_seg move everything after them rigidly, and
+    segments after to_seg move nothing the criteria look at"""
+    nseg = len(segments)
+    if not criteria.rigid_invariant:
+        return 0, nseg - 1
+    children = criteria if isinstance(criteria, CriteriaList) else [criteria]
+    lo = min(min(c.from_seg % nseg, c.to_seg % nseg) for c in children)
+    hi = max(max(c.from_seg % nseg, c.to_seg % nseg) for c in children)
+    if matchlast is not None:
+        # body/site filtering ties segments[matchlast] to segments[-1]
+        lo, hi = min(lo, matchlast % nseg), nseg - 1
+    return lo, hi
+
+
+def _shift_criteria(criteria, lo, nseg):
+    "copy of criteria with segment indices relative to segments[lo]"
+    if isinstance(criteria, CriteriaList):
+        return CriteriaList([_shift_criteria(c, lo, nseg) for c in criteria])
+    criteria = copy.copy(criteria)
+    for name in ('from_seg', 'to_seg', 'last_body_same_as'):
+        if getattr(criteria, name, None) is not None:
+            setattr(criteria, name, getattr(criteria, name) % nseg - lo)
+    return criteria
+
+
+def _expand_free_segments(segments, lo, hi, scores, lowidx, max_results,
+                          choices=None):
+    """full index rows for worms found on segments[lo:hi + 1]
+
+    every choice on the free segments gives the same score, take them in
+    order for each result until there are max_results; choices, rows of
+    free segment indices, limits them to those given"""
+    free = [i for i in range(len(segments)) if not lo <= i <= hi]
+    freesizes = [len(segments[i]) for i in free]
+    nfree = util.bigprod(freesizes) if choices is None else len(choices)
+    nkeep = min(len(scores) * nfree, max_results)
+    irow = np.arange(nkeep)
+    step = min(nfree, max(1, nkeep))  # nfree may not fit in int64
+    which, combo = irow // step, irow % step
+    fullidx = np.empty((nkeep, len(segments)), dtype=lowidx.dtype)
+    fullidx[:, lo:hi + 1] = lowidx[which]
+    if choices is not None:
+        fullidx[:, free] = choices[combo]
+    else:
+        for i, n in zip(reversed(free), reversed(freesizes)):
+            fullidx[:, i] = combo % n
+            combo = combo // n
+    return scores[which], fullidx, nfree
+
+
+def _chain_xforms(segments, used=None):
+    """broadcast positions/connections of every index combination, positions
+    of segments not in used (default all) are left as None"""
+    if used is None: used = range(len(segments))
+    x2exit = [np.asarray(s.x2exit) for s in segments]
+    x2orgn = [np.asarray(s.x2orgn) for s in segments]
     fullaxes = (np.newaxis,) * (len(x2exit) - 1)
     xconn = [x2exit[0][fullaxes], ]
-    xbody = [x2orgn[0][fullaxes], ]
+    xbody = [x2orgn[0][fullaxes] if 0 in used else None, ]
     for iseg in range(1, len(x2exit)):
         fullaxes = (slice(None),) + (np.newaxis,) * iseg
         xconn.append(xconn[iseg - 1] @ x2exit[iseg][fullaxes])
-        xbody.append(xconn[iseg - 1] @ x2orgn[iseg][fullaxes])
-    perm = list(range(len(xbody) - 1, -1, -1)) + [len(xbody), len(xbody) + 1]
-    xbody = [np.transpose(x, perm) for x in xbody]
+        xbody.append(xconn[iseg - 1] @ x2orgn[iseg][fullaxes]
+                     if iseg in used else None)
+    perm = list(range(len(xconn) - 1, -1, -1)) + [len(xconn), len(xconn) + 1]
+    xbody = [None if x is None else np.transpose(x, perm) for x in xbody]
     xconn = [np.transpose(x, perm) for x in xconn]
     return xbody, xconn
 
@@ -554,17 +790,44 @@ __print_best = False
 __best_score = 9e9
 
 
+class _ChunkWorkspace(threading.local):
+    "per thread scratch buffers, reused by every _grow_chunk call"
+
+    def __init__(self):
+        self.buffers = dict()
+
+    def get(self, name, shape, dtype):
+        size = util.bigprod(shape)
+        buf = self.buffers.get(name)
+        if buf is None or buf.dtype != dtype or buf.size < size:
+            buf = self.buffers[name] = np.empty(size, dtype)
+        return buf[:size].reshape(shape)
+
+
+_workspace = _ChunkWorkspace()
+
+
+# what every chunk of a grow run needs, sent to or kept in the workers
+_GrowContext = namedtuple('_GrowContext', [
+    'sampsizes', 'njob', 'segments', 'end', 'criteria', 'thresh',
+    'matchlast', 'every_other', 'max_results', 'jitcrit', 'tile', 'batch',
+    'reach'])
+
+
 def _grow_chunk(samp, segpos, conpos, context):
     os.environ['OMP_NUM_THREADS'] = '1'
     os.environ['MKL_NUM_THREADS'] = '1'
     os.environ['NUMEXPR_NUM_THREADS'] = '1'
-    _, _, segs, end, criteria, thresh, matchlast, _, max_results = context
+    segs, end, criteria = context.segments, context.end, context.criteria
+    thresh, matchlast = context.thresh, context.matchlast
+    max_results = context.max_results
     # print('_grow_chunk', samp, end, thresh, matchlast, max_results)
     ML = matchlast
+    used = criteria.positions_used(len(segs))
+    ndimchunk = conpos[0].ndim - 2
     # body must match, and splice sites must be distinct
     if ML is not None:
         # print('  ML')
-        ndimchunk = segpos[0].ndim - 2
         bidB = segs[-1].bodyid[samp[-1]]
         site3 = segs[-1].entrysiteid[samp[-1]]
         if ML < ndimchunk:
@@ -572,9 +835,13 @@ def _grow_chunk(samp, segpos, conpos, context):
             site1 = segs[ML].entrysiteid
             site2 = segs[ML].exitsiteid
             allowed = (bidA == bidB) * (site1 != site3) * (site2 != site3)
-            idx = (slice(None),) * ML + (allowed,)
-            segpos = segpos[: ML] + [x[idx] for x in segpos[ML:]]
-            conpos = conpos[: ML] + [x[idx] for x in conpos[ML:]]
+            segpos = segpos[: ML] + [
+                None if x is None else
+                _compress(allowed, x, ML, ('mlsegpos', i))
+                for i, x in enumerate(segpos[ML:end])]
+            conpos = conpos[: ML] + [
+                _compress(allowed, x, ML, ('mlconpos', i))
+                for i, x in enumerate(conpos[ML:end])]
             idxmap = np.where(allowed)[0]
         else:
             bidA = segs[ML].bodyid[samp[ML - ndimchunk]]
@@ -585,11 +852,15 @@ def _grow_chunk(samp, segpos, conpos, context):
     segpos, conpos = segpos[:end], conpos[:end]
     # print('  do geom')
     for iseg, seg in enumerate(segs[end:]):
-        segpos.append(conpos[-1] @ seg.x2orgn[samp[iseg]])
+        segpos.append(_matmul(conpos[-1], seg.x2orgn[samp[iseg]],
+                              ('segpos', iseg))
+                      if end + iseg in used else None)
         if seg is not segs[-1]:
-            conpos.append(conpos[-1] @ seg.x2exit[samp[iseg]])
+            conpos.append(_matmul(conpos[-1], seg.x2exit[samp[iseg]],
+                                  ('conpos', iseg)))
     # print('  scoring')
-    score = criteria.score(segpos=segpos)
+    score = _cascade_score(criteria, segpos, thresh)
+    score = np.broadcast_to(score, conpos[-1].shape[:-2])
     # print('  scores shape', score.shape)
     if __print_best:
         global __best_score
@@ -604,35 +875,258 @@ def _grow_chunk(samp, segpos, conpos, context):
         order = np.argsort(score[ilow0])
         ilow0 = ilow0[order[:max_results]]
     sampidx = tuple(np.repeat(i, len(ilow0[0])) for i in samp)
-    lowpostmp = []
-    # print('  make lowpos')
-    for iseg in range(len(segpos)):
-        ilow = ilow0[: iseg + 1] + (0,) * (segpos[0].ndim - 2 - (iseg + 1))
-        lowpostmp.append(segpos[iseg][ilow])
     ilow1 = (ilow0 if (ML is None or ML >= ndimchunk) else
              ilow0[:ML] + (idxmap[ilow0[ML]],) + ilow0[ML + 1:])
-    return score[ilow0], np.array(ilow1 + sampidx).T, np.stack(lowpostmp, 1)
+    return score[ilow0], np.array(ilow1 + sampidx).T
+
+
+def _grow_batch(samps, segpos, conpos, context):
+    """_grow_chunk for many tail samples at once, the samples are a new
+    leading axis and matchlast filtering on the prefix is a score mask"""
+    segs, end, criteria = context.segments, context.end, context.criteria
+    thresh, ML = context.thresh, context.matchlast
+    samps = np.array(samps)
+    if ML is not None:
+        # body must match, and splice sites must be distinct
+        bidB = segs[-1].bodyid[samps[:, -1]]
+        site3 = segs[-1].entrysiteid[samps[:, -1]]
+        if ML >= end:
+            iML = samps[:, ML - end]
+            ok = ((segs[ML].bodyid[iML] == bidB) *
+                  (segs[ML].entrysiteid[iML] != site3) *
+                  (segs[ML].exitsiteid[iML] != site3))
+            samps = samps[ok]
+            if len(samps) == 0: return
+    used = criteria.positions_used(len(segs))
+    lead = (slice(None),) + (np.newaxis,) * end
+    segpos = [None if x is None else x[np.newaxis] for x in segpos[:end]]
+    chunkshape = conpos[end - 1].shape[:-2]
+    conpos = conpos[end - 1][np.newaxis]
+    for iseg, seg in enumerate(segs[end:]):
+        isamp = samps[:, iseg]
+        segpos.append(_matmul(conpos, seg.x2orgn[isamp][lead],
+                              ('bsegpos', iseg))
+                      if end + iseg in used else None)
+        if seg is not segs[-1]:
+            conpos = _matmul(conpos, seg.x2exit[isamp][lead],
+                             ('bconpos', iseg))
+    score = _cascade_score(criteria, segpos, thresh)
+    score = np.broadcast_to(score, (len(samps),) + chunkshape)
+    if ML is not None and ML < end:
+        allowed = ((segs[ML].bodyid == bidB[:, None]) *
+                   (segs[ML].entrysiteid != site3[:, None]) *
+                   (segs[ML].exitsiteid != site3[:, None]))
+        shape = (len(samps),) + (1,) * ML + (-1,) + (1,) * (end - ML - 1)
+        score = np.where(allowed.reshape(shape), score, np.inf)
+    ilow = np.nonzero(score < thresh)
+    lowidx = np.stack(ilow[1:] + tuple(samps[ilow[0]].T), 1)
+    return score[ilow], lowidx
+
+
+def _cascade_score(criteria, segpos, thresh):
+    """criteria.score, computed in full only where score_lower_bound
+    doesn't already reject the worm; rejected worms score inf"""
+    bound = criteria.score_lower_bound(segpos=segpos)
+    if np.ndim(bound) == 0:
+        return criteria.score(segpos=segpos)
+    maybe = bound < thresh
+    nmaybe = np.count_nonzero(maybe)
+    if nmaybe > maybe.size / 4:  # not worth the gather
+        return criteria.score(segpos=segpos)
+    score = np.full(maybe.shape, np.inf)
+    if nmaybe:
+        shape = maybe.shape + (4, 4)
+        segpos = [None if x is None else np.broadcast_to(x, shape)[maybe]
+                  for x in segpos]
+        score[maybe] = criteria.score(segpos=segpos)
+    return score
+
+
+def _matmul(a, b, name):
+    "a @ b into a reused workspace buffer"
+    # np.broadcast_shapes needs numpy >= 1.20
+    shape = (np.broadcast(a[..., 0, 0], b[..., 0, 0]).shape +
+             (a.shape[-2], b.shape[-1]))
+    out = _workspace.get(name, shape, np.result_type(a, b))
+    return np.matmul(a, b, out=out)
+
+
+def _compress(mask, a, axis, name):
+    "a[..., mask, ...] on axis into a reused workspace buffer"
+    shape = a.shape[:axis] + (np.count_nonzero(mask),) + a.shape[axis + 1:]
+    out = _workspace.get(name, shape, a.dtype)
+    return np.compress(mask, a, axis=axis, out=out)
+
+
+def _grow_chunk_jit(samp, prefix, context):
+    "same as _grow_chunk, but scores with the fused kernels.chunk_kernel"
+    segs, end, criteria = context.segments, context.end, context.criteria
+    thresh, ML, jitcrit = context.thresh, context.matchlast, context.jitcrit
+    x2orgn, x2exit, offsets, nprefix = prefix
+    mlseg, mlallowed = -1, np.ones(1, dtype='?')
+    if ML is not None:
+        # body must match, and splice sites must be distinct
+        bidB = segs[-1].bodyid[samp[-1]]
+        site3 = segs[-1].entrysiteid[samp[-1]]
+        if ML < end:
+            mlseg = ML
+            mlallowed = ((segs[ML].bodyid == bidB) *
+                         (segs[ML].entrysiteid != site3) *
+                         (segs[ML].exitsiteid != site3))
+        else:
+            bidA = segs[ML].bodyid[samp[ML - end]]
+            site1 = segs[ML].entrysiteid[samp[ML - end]]
+            site2 = segs[ML].exitsiteid[samp[ML - end]]
+            if bidA != bidB or site3 == site2 or site3 == site1:
+                return
+    tail = segs[end:]
+    tail_orgn = np.stack([s.x2orgn[i] for s, i in zip(tail, samp)])
+    tail_exit = np.stack([s.x2exit[i] for s, i in zip(tail, samp)])
+    total = util.bigprod(nprefix)
+    out_score, out_idx = np.empty(total), np.empty(total, dtype='i8')
+    nlow = kernels.chunk_kernel(
+        x2orgn, x2exit, offsets, nprefix, tail_orgn.astype('f8'),
+        tail_exit.astype('f8'), jitcrit, mlseg, mlallowed, thresh,
+        out_score, out_idx)
+    if nlow == 0: return
+    ilow = np.unravel_index(out_idx[:nlow], nprefix)
+    lowidx = np.stack(ilow + tuple(np.repeat(i, nlow) for i in samp), 1)
+    # positions and scores of the few survivors exactly as _grow_chunk
+    lowpos = _refold_segments(segs, lowidx, segs[0].x2orgn.dtype.str[1:])
+    score = criteria.score(segpos=[lowpos[:, i] for i in range(len(segs))])
+    ok = score < thresh
+    return score[ok], lowidx[ok]
+
+
+def _resolve_context(context):
+    """context tuple and prefix positions for a job, context may be a token
+    registered by util.init_worker_context, in which case the prefix is
+    memoized"""
+    if not isinstance(context, str):
+        return context, _chunk_prefix(context)
+    state = util.worker_contexts[context]
+    if 'prefix' not in state:
+        state['prefix'] = _chunk_prefix(state['context'])
+    return state['context'], state['prefix']
+
+
+def _chunk_prefix(context):
+    """data common to all chunks: positions, or tables for the jit kernel;
+    positions stop before segments[end - 1] if it is tiled"""
+    segments, end, jitcrit, tile = (context.segments, context.end,
+                                    context.jitcrit, context.tile)
+    if jitcrit is not None:
+        return kernels.prefix_tables(segments[:end])
+    used = context.criteria.positions_used(len(segments))
+    if tile is None:
+        return _chain_xforms(segments[:end], used)
+    return _chain_xforms(segments[:end - 1], used) if end > 1 else None
+
+
+def _tile_chunk(itile, context, prefix):
+    """context and prefix for one tile of segments[end - 1], rows of the
+    tile are numbered from zero"""
+    segments, end, jitcrit, tile = (context.segments, context.end,
+                                    context.jitcrit, context.tile)
+    rows = slice(itile * tile, (itile + 1) * tile)
+    seg = segments[end - 1].subset(rows)
+    tsegs = list(segments)
+    tsegs[end - 1] = seg
+    context = context._replace(segments=tsegs)
+    if jitcrit is not None:
+        x2orgn, x2exit, offsets, nprefix = prefix
+        offsets, nprefix = offsets.copy(), nprefix.copy()
+        offsets[end - 1] += rows.start
+        nprefix[end - 1] = len(seg.bodyid)
+        return context, (x2orgn, x2exit, offsets, nprefix)
+    used = context.criteria.positions_used(len(segments))
+    x2orgn, x2exit = np.asarray(seg.x2orgn), np.asarray(seg.x2exit)
+    if prefix is None:
+        return context, ([x2orgn if 0 in used else None], [x2exit])
+    segpos = [None if x is None else x[..., None, :, :] for x in prefix[0]]
+    conpos = [x[..., None, :, :] for x in prefix[1]]
+    segpos.append(conpos[-1] @ x2orgn if end - 1 in used else None)
+    conpos.append(conpos[-1] @ x2exit)
+    return context, (segpos, conpos)
+
+
+def _grow_sample(samp, prefix, context):
+    "one chunk, with samp[0] the tile index if segments[end - 1] is tiled"
+    end, jitcrit, tile = context.end, context.jitcrit, context.tile
+    if tile is not None:
+        itile, samp = samp[0], samp[1:]
+        context, prefix = _tile_chunk(itile, context, prefix)
+    if jitcrit is None:
+        chunk = _grow_chunk(samp, prefix[0], prefix[1], context)
+    else:
+        chunk = _grow_chunk_jit(samp, prefix, context)
+    if chunk is not None and tile is not None:
+        chunk[1][:, end - 1] += itile * tile
+    return chunk
 
 
 def _grow_chunks(ijob, context):
     os.environ['OMP_NUM_THREADS'] = '1'
     os.environ['MKL_NUM_THREADS'] = '1'
     os.environ['NUMEXPR_NUM_THREADS'] = '1'
-    sampsizes, njob, segments, end, _, _, _, every_other, max_results = context
-    samples = list(util.MultiRange(sampsizes)[ijob::njob * every_other])
-    segpos, connpos = _chain_xforms(segments[:end])  # common data
-    args = [samples, it.repeat(segpos),
-            it.repeat(connpos), it.repeat(context)]
-    chunks = list(map(_grow_chunk, *args))
+    context, prefix = _resolve_context(context)
+    samples = list(util.MultiRange(context.sampsizes)[
+        ijob::context.njob * context.every_other])
+    samples = _prune_samples(samples, context)
+    segments, jitcrit, tile, batch = (context.segments, context.jitcrit,
+                                      context.tile, context.batch)
+    if batch > 1 and jitcrit is None and tile is None:
+        chunks = [_grow_batch(samples[i:i + batch], prefix[0], prefix[1],
+                              context)
+                  for i in range(0, len(samples), batch)]
+    else:
+        chunks = [_grow_sample(samp, prefix, context) for samp in samples]
     chunks = [c for c in chunks if c is not None]
     if not chunks: return None
     scores = np.concatenate([x[0] for x in chunks])
     lowidx = np.concatenate([x[1] for x in chunks])
-    lowpos = np.concatenate([x[2] for x in chunks])
-    order = np.argsort(scores)
-    return [scores[order[:max_results]],
-            lowidx[order[:max_results]],
-            lowpos[order[:max_results]]]
+    order = np.argsort(scores)[:context.max_results]
+    # chunks only kept positions the criteria read, rebuild all for the few
+    lowpos = _refold_segments(segments, lowidx[order],
+                              segments[0].x2orgn.dtype.str[1:])
+    return [scores[order], lowidx[order], lowpos]
+
+
+def _chunk_reach(segments, criteria, end):
+    """reference entries for segments[:end] and, per criteria, the
+    Reach.slacks of any worm from the reference worm with the same tail;
+    None if there is no score_lower_bound or the rotations alone can be
+    anything, then no bound can be positive"""
+    if not engines.has_score_bound(criteria): return None
+    refidx, reach = engines.segment_reach(segments, range(end))
+    slacks = reach.slacks(criteria)
+    if all(rot >= np.pi for rot, trans in slacks): return None
+    return refidx, slacks
+
+
+def _prune_samples(samples, context, blocksize=4096):
+    """drop tail samples whose whole chunk can't score below thresh, by
+    score_lower_bound of the reference worm relaxed by _chunk_reach"""
+    segments, end, criteria, thresh = (context.segments, context.end,
+                                       context.criteria, context.thresh)
+    tile, reach = context.tile, context.reach
+    if reach is None or not samples: return samples
+    refidx, slacks = reach
+    children = criteria if isinstance(criteria, CriteriaList) else [criteria]
+    keep = list()
+    for i in range(0, len(samples), blocksize):
+        tails = np.array(samples[i:i + blocksize], dtype='i8')
+        if tile is not None: tails = tails[:, 1:]
+        idx = np.tile(refidx, (len(tails), 1))
+        idx[:, end:] = tails
+        pos = _refold_segments(segments, idx, 'f8')
+        segpos = [pos[:, j] for j in range(len(segments))]
+        bound = sum(c.score_lower_bound(segpos=segpos, slack=rot,
+                                        trans_slack=trans)
+                    for c, (rot, trans) in zip(children, slacks))
+        keep.append(np.broadcast_to(bound < thresh, (len(tails),)))
+    keep = np.concatenate(keep)
+    return [s for s, k in zip(samples, keep) if k]
 
 
 def _check_topology(segments, criteria, expert=False):
@@ -678,34 +1172,62 @@ def _check_topology(segments, criteria, expert=False):
 
 
 def _grow(segments, criteria, accumulator, **kw):
-    # terrible hack... xfering the poses too expensive
-    tmp = {spl: (spl.body, spl.chains)
-           for seg in segments for spl in seg.spliceables}
-    for seg in segments:
-        for spl in seg.spliceables:
-            spl.body, spl.chains = None, None  # poses not pickleable...
-
+    # workers only get the pose-free geometry, poses are too expensive
+    # to transfer (and not always pickleable)
+    segments = Segments(segments).geometry()
+    if kw['precision'] != 'f8':
+        segments = segments.astype(kw['precision'])
     sizes = [len(s) for s in segments]
     ntot = util.bigprod(sizes)
-    with kw['executor'](**kw['executor_args']) as pool:
-        context = (sizes[kw['end']:], kw['njob'], segments, kw['end'],
-                   criteria, kw['thresh'], kw['matchlast'], kw['every_other'],
-                   kw['max_results'])
-        args = [range(kw['njob'])] + [it.repeat(context)]
-        util.tqdm_parallel_map(
-            pool=pool,
-            function=_grow_chunks,
-            accumulator=accumulator,
-            map_func_args=args,
-            batch_size=kw['nworker'] * 8,
-            unit='K worms',
-            ascii=0,
-            desc='growing worms',
-            unit_scale=int(ntot / kw['njob'] / 1000 / kw['every_other']),
-            disable=kw['verbosity'] < 0
-        )
-
-    # put the poses back...
-    for seg in segments:
-        for spl in seg.spliceables:
-            spl.body, spl.chains = tmp[spl]
+    executor = kw['executor']
+    if (util.shared_memory is not None and isinstance(executor, type) and
+            issubclass(executor, ProcessPoolExecutor)):
+        # arrays go into shared memory once, jobs pickle only descriptors
+        with util.SharedArrayPool() as shm:
+            segments = segments.shared(shm)
+            if hasattr(criteria, 'shared'):
+                criteria = criteria.shared(shm)
+            _grow_map(segments, criteria, accumulator, sizes, ntot, **kw)
+    else:
+        _grow_map(segments, criteria, accumulator, sizes, ntot, **kw)
+
+
+def _grow_map(segments, criteria, accumulator, sizes, ntot, **kw):
+    jitcrit = None
+    if kw['backend'] == 'numba' and kernels.HAVE_NUMBA:
+        jitcrit = kernels.encode_criteria(criteria, len(segments))
+    end, tile = kw['end'], kw['tile']
+    sampsizes = sizes[end:]
+    if tile is not None:
+        # first sample index picks the tile of segments[end - 1]
+        sampsizes = [-(-sizes[end - 1] // tile)] + sampsizes
+    # short prefixes make small chunks, score several tail samples at once
+    batch = max(1, int(kw['memsize'] / 64 / _chunk_counts(sizes, end,
+                                                           tile)[0]))
+    reach = _chunk_reach(segments, criteria, end)
+    context = _GrowContext(
+        sampsizes=sampsizes, njob=kw['njob'], segments=segments, end=end,
+        criteria=criteria, thresh=kw['thresh'], matchlast=kw['matchlast'],
+        every_other=kw['every_other'], max_results=kw['max_results'],
+        jitcrit=jitcrit, tile=tile, batch=batch, reach=reach)
+    executor = kw['executor']
+    # context is sent once per worker if it can, jobs send only a token
+    job_context, executor_args = util.resident_context(
+        executor, dict(kw['executor_args']), context)
+    try:
+        with executor(**executor_args) as pool:
+            util.tqdm_parallel_map(
+                pool=pool,
+                function=_grow_chunks,
+                accumulator=accumulator,
+                map_func_args=[range(kw['njob']), it.repeat(job_context)],
+                batch_size=kw['nworker'] * 8,
+                unit='K worms',
+                ascii=0,
+                desc='growing worms',
+                unit_scale=int(ntot / kw['njob'] / 1000 / kw['every_other']),
+                disable=kw['verbosity'] < 0
+            )
+    finally:
+        if job_context is not context:
+            del util.worker_contexts[job_context]
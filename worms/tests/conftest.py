@@ -1,5 +1,6 @@
 import pytest
 import os
+import numpy as np
 from os.path import join, dirname, abspath, exists
 try:
     import pyrosetta
@@ -119,3 +120,43 @@ def hetC2A_pose(pdbdir):
 @pytest.fixture(scope='session')
 def hetC2B_pose(pdbdir):
     return get_pose(pdbdir, 'hetC2B.pdb')
+
+
+@pytest.fixture(scope='session')
+def helix_dimer_segments(c1pose, c2pose):
+    "helix, dimer, helix, helix, helix Segments for the grow engine tests"
+    if not HAVE_PYROSETTA:
+        return None
+    from worms import Spliceable, Segment
+    helix = Spliceable(c1pose, sites=[((1, 2, 3), 'N'), ('-4:', 'C')])
+    dimer = Spliceable(c2pose, sites=[('1,:2', 'N'), ('1,-1:', 'C')])
+    return ([Segment([helix], exit='C'), Segment([dimer], 'N', 'C')] +
+            [Segment([helix], 'N', 'C')] * 2 +
+            [Segment([helix], entry='N')])
+
+
+class RandomSegment:
+    """stand-in Segment with only random x2orgn and x2exit; given rot and
+    cart, x2orgn of the n entries are within about rot radians and cart
+    of one another, and all share one x2orgn to x2exit offset"""
+
+    def __init__(self, n, rot=None, cart=None):
+        from homog import hrot, rand_xform
+        if rot is None:
+            self.x2orgn = rand_xform(n, cart_sd=5)
+            self.x2exit = self.x2orgn @ rand_xform(n, cart_sd=5)
+            return
+        small = hrot(np.random.randn(n, 3), np.random.randn(n) * rot,
+                     degrees=False)
+        small[:, :3, 3] = np.random.randn(n, 3) * cart
+        self.x2orgn = rand_xform(cart_sd=5) @ small
+        self.x2exit = self.x2orgn @ rand_xform(cart_sd=5)
+
+    def __len__(self):
+        return len(self.x2orgn)
+
+
+@pytest.fixture
+def random_segment():
+    "RandomSegment, for search tests that need no poses"
+    return RandomSegment
@@ -1,6 +1,9 @@
 from .. import util
+import sys
 import itertools as it
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import pytest
+import numpy as np
 try:
     import pyrosetta
     HAVE_PYROSETTA = True
@@ -20,3 +23,108 @@ def test_MultiRange():
     for i, tup in enumerate(prod):
         assert tup == mr[i]
     assert i + 1 == len(mr)
+
+
+@pytest.mark.skipif('not HAVE_PYROSETTA')
+def test_get_bb_stubs_same_as_rosetta(c1pose, c3pose):
+    for pose in (c1pose, c3pose):
+        stubs = util.get_bb_stubs(pose)
+        assert stubs.shape == (len(pose), 4, 4)
+        assert np.allclose(stubs, util.get_bb_stubs_rosetta(pose))
+    which = [3, 1, 7, 7]
+    assert np.allclose(util.get_bb_stubs(c1pose, which),
+                       util.get_bb_stubs_rosetta(c1pose, which))
+
+
+def test_bb_stubs_from_coords():
+    coords = np.random.randn(10, 3, 3) * 10
+    stubs = util.bb_stubs_from_coords(coords)
+    rot = stubs[:, :3, :3]
+    assert np.allclose(rot @ rot.swapaxes(-1, -2), np.eye(3))
+    assert np.allclose(np.linalg.det(rot), 1)
+    assert np.allclose(stubs[:, :3, 3], coords[:, 1])
+    assert np.allclose(stubs[:, 3], [0, 0, 0, 1])
+    n_ca = coords[:, 0] - coords[:, 1]
+    n_ca /= np.linalg.norm(n_ca, axis=-1)[:, None]
+    assert np.allclose(rot[:, :, 0], n_ca)
+
+
+class _HasArrays(util.SharedArraysMixin):
+    _array_names = ('a', 'b')
+
+    def __init__(self):
+        self.a = np.arange(12.0).reshape(3, 4)
+        self.b = np.array([3, 1, 2], dtype='i8')
+        self.c = 'not shared'
+
+
+@pytest.mark.skipif('util.shared_memory is None')
+def test_shared_arrays_pickle():
+    import pickle
+    orig = _HasArrays()
+    with util.SharedArrayPool() as pool:
+        shared = orig.shared(pool)
+        data = pickle.dumps(shared)
+        assert len(data) < len(pickle.dumps(orig))
+        new = pickle.loads(data)
+        assert new.c == 'not shared'
+        assert np.all(new.a == orig.a) and new.a.dtype == orig.a.dtype
+        assert np.all(new.b == orig.b) and new.b.dtype == orig.b.dtype
+        del new
+    assert len(pool.blocks) == 0
+
+
+def test_KeyIndex():
+    a = np.array([3, 1, 2, 1, 0])
+    b = np.array([0, 5, 2, 4, 9])
+    index = util.KeyIndex(a, b)
+    assert len(index) == 5
+    assert np.all(index.lookup(a, b) == np.arange(5))
+    assert np.all(index.lookup([1, 1, 7], [4, 0, 0]) == [3, -1, -1])
+    empty = util.KeyIndex(a[:0], b[:0])
+    assert np.all(empty.lookup(a, b) == -1)
+
+
+def test_FactorizedXforms():
+    left = np.random.rand(3, 4, 4)
+    right = np.random.rand(5, 4, 4)
+    ileft = np.array([0, 0, 1, 2, 2, 2])
+    iright = np.array([1, 4, 0, 2, 3, 4])
+    x = util.FactorizedXforms(left, ileft, right, iright)
+    ref = left[ileft] @ right[iright]
+    assert len(x) == 6 and x.shape == (6, 4, 4)
+    assert np.allclose(np.asarray(x), ref)
+    assert np.allclose(x[4], ref[4])
+    assert np.allclose(x[[5, 0]], ref[[5, 0]])
+    assert np.allclose(np.asarray(util.FactorizedXforms(left, ileft)),
+                       left[ileft])
+
+
+def test_rigid_inv():
+    import homog as hm
+    x = hm.rand_xform(100)
+    assert np.allclose(util.rigid_inv(x), np.linalg.inv(x))
+    assert np.allclose(util.rigid_inv(x[3]), np.linalg.inv(x[3]))
+    assert np.allclose(util.rigid_inv(x.astype('f4')) @ x, np.eye(4),
+                       atol=1e-5)
+
+
+def test_resident_context(monkeypatch):
+    context, calls = ('context',), list()
+    token, args = util.resident_context(
+        ProcessPoolExecutor, dict(initializer=calls.append,
+                                  initargs=('user',)), context)
+    try:
+        if sys.version_info < (3, 7):
+            assert token is context and 'initargs' not in args
+        else:
+            args['initializer'](*args['initargs'])
+            assert util.worker_contexts[token]['context'] is context
+            assert calls == ['user']  # caller's initializer chained
+    finally:
+        util.worker_contexts.pop(token, None)
+    monkeypatch.setattr(sys, 'version_info', (3, 6, 0))
+    token, args = util.resident_context(ProcessPoolExecutor, dict(), context)
+    assert token is context and args == dict()
+    token, args = util.resident_context(ThreadPoolExecutor, dict(), context)
+    assert util.worker_contexts.pop(token)['context'] is context
@@ -1,4 +1,5 @@
 import pytest
+import os
 import pickle
 import numpy as np
 from homog import hrot, htrans, axis_angle_of, axis_ang_cen_of
@@ -69,6 +70,106 @@ def test_Segment_split_merge_invalid_pairs(c1pose):
     assert np.all(tail_idx2[idx >= 0] == tail_idx[idx >= 0])
 
 
+@only_if_pyrosetta
+def test_Segment_merge_split_idx_same_as_slow(c1pose):
+    helix = Spliceable(c1pose, sites=[((1, 2, 3), 'N'), ((9, 10, 11), 'C')],
+                       min_seg_len=8)
+    helix2 = Spliceable(c1pose, sites=[((2, 5), 'N'), ((8, 11, 13), 'C')])
+    seg = Segment([helix, helix2], 'NC')
+    head, tail = seg.make_head(), seg.make_tail()
+    head_idx = np.repeat(np.arange(len(head)), len(tail))
+    tail_idx = np.tile(np.arange(len(tail)), len(head))
+    idx = seg.merge_idx_fast(head, head_idx, tail, tail_idx)
+    assert np.all(idx == seg.merge_idx_slow(head, head_idx, tail, tail_idx))
+    assert np.sum(idx >= 0) == len(seg)
+    idx = np.arange(len(seg))
+    for a, b in zip(seg.split_idx(idx, head, tail),
+                    seg.split_idx_slow(idx, head, tail)):
+        assert np.all(a == b)
+
+
+@only_if_pyrosetta
+def test_Segment_shared_data(c1pose):
+    helix = Spliceable(c1pose, sites=[((1, 2, 3), 'N'), ((9, 10, 11), 'C')])
+    seg1, seg2 = Segment([helix], 'NC'), Segment([helix], 'N', 'C')
+    assert seg1.x2exit is seg2.x2exit and seg1.stubs is seg2.stubs
+    assert Segment([helix], 'N_').x2exit is not seg1.x2exit
+    head1, head2 = seg1.make_head(), seg2.make_head()
+    assert head1.x2orgn is head2.x2orgn
+    same = Spliceable(c1pose, sites=[((1, 2, 3), 'N'), ((9, 10, 11), 'C')])
+    assert Segment([same], 'NC').x2exit is seg1.x2exit
+    helix.bodyid = 7  # shared by content, not by object
+    seg3 = Segment([helix], 'NC')
+    assert seg3.bodyid is not seg1.bodyid and np.all(seg3.bodyid == 7)
+
+
+@only_if_pyrosetta
+def test_Segment_make_head_tail_same_as_init(c1pose):
+    sites = [((1, 2, 3), 'N'), ((9, 10, 11), 'C')]
+    sites2 = [((5,), 'N'), ((2,), 'N'), ((4, 8, 11, 13), 'C')]
+    # min_seg_len leaves out exit 4 for the first entry site of helix2
+    helix = Spliceable(c1pose, sites=sites)
+    helix2 = Spliceable(c1pose, sites=sites2, min_seg_len=3)
+    seg = Segment([helix, helix2], 'NC')
+    head, tail = seg.make_head(), seg.make_tail()
+    assert (head.entrypol, head.exitpol) == ('N', None)
+    assert (tail.entrypol, tail.exitpol) == (None, 'C')
+    other = [Spliceable(c1pose, sites=sites),
+             Spliceable(c1pose, sites=sites2, min_seg_len=3)]
+    for derived, ref in ((head, Segment(other, 'N_')),
+                         (tail, Segment(other, '_C'))):
+        assert len(derived) == len(ref)
+        for name in Segment._array_names:
+            assert np.allclose(getattr(derived, name), getattr(ref, name))
+
+
+@only_if_pyrosetta
+def test_Segment_plain_after_make_head(c1pose):
+    sites = [(':4', 'N'), ('-4:', 'C')]
+    helix = Spliceable(c1pose, sites=sites, min_seg_len=12)
+    head = Segment([helix], 'NC').make_head()
+    tail = Segment([helix], 'NC').make_tail()
+    fresh = Spliceable(c1pose, sites=sites, min_seg_len=12)
+    for plain, ref in ((Segment([helix], 'N_'), Segment([fresh], 'N_')),
+                       (Segment([helix], '_C'), Segment([fresh], '_C'))):
+        assert len(plain) == len(ref)
+        for name in Segment._array_names:
+            assert np.allclose(getattr(plain, name), getattr(ref, name))
+    assert len(head) < len(Segment([helix], 'N_'))
+    assert head.x2orgn is Segment([helix], 'NC').make_head().x2orgn
+    assert len(tail) < len(Segment([helix], '_C'))
+
+@only_if_pyrosetta
+def test_Segment_compact(c1pose, monkeypatch):
+    helix = Spliceable(c1pose, sites=[((1, 2, 3), 'N'), ((9, 10, 11), 'C')])
+    seg = Segment([helix], 'NC')
+    compact = Segment([helix], 'NC', compact=True)
+    assert isinstance(compact.x2exit, util.FactorizedXforms)
+    assert compact.x2exit.nbytes < seg.x2exit.nbytes
+    for name in Segment._array_names:
+        assert np.allclose(getattr(seg, name), np.asarray(getattr(compact,
+                                                                  name)))
+    assert np.allclose(seg.x2exit[3], compact.x2exit[3])
+    segments = [Segment([helix], exit='C'),
+                compact, compact,
+                Segment([helix], entry='N')]
+    worms = grow(segments, Cyclic('C2', lever=20), thresh=20)
+    ref = grow([segments[0], seg, seg, segments[-1]], Cyclic('C2', lever=20),
+               thresh=20)
+    assert np.allclose(worms.scores, ref.scores)
+    assert np.all(worms.indices == ref.indices)
+    # engines look up compact transforms by entry, in small blocks here
+    monkeypatch.setattr(engines, '_BLOCK', 5)
+    bounds = engines._Bounds(Segments(segments).geometry(),
+                             Cyclic('C2', lever=20))
+    assert isinstance(bounds.x2exit[1], util.FactorizedXforms)
+    for kw in (dict(engine='dfs'), dict(engine='dp'),
+               dict(engine='hierarchical'), dict(cluster_tol=0.5)):
+        worms = grow(segments, Cyclic('C2', lever=20), thresh=20, **kw)
+        assert np.allclose(worms.scores, ref.scores)
+        assert set(map(tuple, worms.indices)) == set(map(tuple, ref.indices))
+
+
 @only_if_pyrosetta
 def test_sym_bug(c1pose, c2pose):
     helix = Spliceable(
@@ -253,6 +354,101 @@ def test_segment_geom(c1pose):
         assert np.allclose(stubs[ir - 1] @ e2x, stubs[jr - 1], atol=1e-5)
 
 
+@only_if_pyrosetta
+def test_init_segment_data_same_as_slow(c1pose, c2pose):
+    helix = Spliceable(c1pose, sites=[(':4', 'N'), ('-4:', 'C')],
+                       min_seg_len=5)
+    dimer = Spliceable(c2pose, sites=[('1,:2', 'N'), ('1,-1:', 'C'),
+                                      ('2,:2', 'N'), ('2,-1:', 'C')],
+                       allowed_pairs=[(0, 1), (2, 1), (2, 3), (0, 2), (3, 1)])
+    names = ('x2exit', 'x2orgn', 'entrysiteid', 'entryresid',
+             'exitsiteid', 'exitresid', 'bodyid')
+    for entryexit in ('_C', 'NC', 'CN', 'NN', 'CC', 'N_', 'C_'):
+        seg = Segment([helix, dimer, helix], entryexit, expert=True)
+        fast = [getattr(seg, n) for n in names]
+        seg.init_segment_data_slow()
+        slow = [getattr(seg, n) for n in names]
+        for n, a, b in zip(names, fast, slow):
+            assert a.shape == b.shape, n
+            assert np.allclose(a, b), n
+
+
+@only_if_pyrosetta
+def test_segment_cache_dir(tmpdir, c1pose, c2pose):
+    cache_dir = str(tmpdir)
+    helix = Spliceable(c1pose, sites=[(':4', 'N'), ('-4:', 'C')])
+    dimer = Spliceable(c2pose, sites=[('1,:2', 'N'), ('2,-1:', 'C')])
+    ref = Segment([helix, dimer], 'NC', expert=True)
+    seg1 = Segment([helix, dimer], 'NC', expert=True, cache_dir=cache_dir)
+    seg2 = Segment([helix, dimer], 'NC', expert=True, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    for name in Segment._array_names:
+        assert isinstance(getattr(seg2, name), np.memmap)
+        assert np.all(getattr(ref, name) == getattr(seg1, name))
+        assert np.all(getattr(ref, name) == getattr(seg2, name))
+    # stubs come from the cache too, once segments in memory are gone
+    del seg1, seg2
+    seg3 = Segment([helix, dimer], 'NC', expert=True, cache_dir=cache_dir)
+    assert all(isinstance(x, np.memmap) for x in seg3.stubs)
+    assert all(np.allclose(a, b) for a, b in zip(ref.stubs, seg3.stubs))
+    Segment([helix, dimer], 'N_', expert=True, cache_dir=cache_dir)
+    helix2 = Spliceable(c1pose, sites=[(':4', 'N'), ('-4:', 'C')],
+                        min_seg_len=9)
+    Segment([helix2, dimer], 'NC', expert=True, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 3
+
+
+@only_if_pyrosetta
+def test_segment_geometry(c1pose, c2pose):
+    helix = Spliceable(c1pose, sites=[(':4', 'N'), ('-4:', 'C')])
+    dimer = Spliceable(c2pose, sites=[('1,:2', 'N'), ('2,-1:', 'C')])
+    seg = Segment([helix, dimer], 'NC', expert=True)
+    geom = pickle.loads(pickle.dumps(seg.geometry()))
+    assert not hasattr(geom.spliceables[0], 'body')
+    assert (geom.entrypol, geom.exitpol) == ('N', 'C')
+    assert len(geom) == len(seg)
+    assert geom.spliceables[1].nsite == dimer.nsite
+    for name in Segment._array_names:
+        assert np.all(getattr(seg, name) == getattr(geom, name))
+    assert seg.spliceables[0].body is c1pose
+    geoms = Segments([seg, seg]).geometry()
+    assert len(geoms) == 2 and geoms[0].geometry() is geoms[0]
+
+
+def test_xindexed_criteria_is_in_xindex_set():
+    xindex = {7: [0], 3: [1], 11: [2, 3]}
+    crit = XIndexedCriteria(xindex, None, 2)
+    idx = np.array([[3, 4], [11, 12], [0, 7]])
+    score = crit.is_in_xindex_set(idx)
+    assert score.shape == idx.shape
+    assert np.all((score == 0) == np.isin(idx, list(xindex)))
+    empty = XIndexedCriteria(dict(), None, 2)
+    assert np.all(empty.is_in_xindex_set(idx) > 0)
+
+
+@only_if_pyrosetta
+def test_worker_context_prefix_memo(c1pose):
+    from ..search import _resolve_context, _GrowContext
+    helix = Spliceable(c1pose, sites=[(1, 'N'), ('-4:', 'C')])
+    segments = Segments([Segment([helix], exit='C'),
+                         Segment([helix], 'N', 'C'),
+                         Segment([helix], entry='N')]).geometry()
+    context = _GrowContext(
+        sampsizes=[len(segments[2])], njob=1, segments=segments, end=2,
+        criteria=Cyclic(2), thresh=1, matchlast=None, every_other=1,
+        max_results=10, jitcrit=None, tile=None, batch=1, reach=None)
+    util.init_worker_context('test_token', context)
+    try:
+        ctx, prefix = _resolve_context('test_token')
+        assert ctx is context
+        assert _resolve_context('test_token')[1] is prefix
+        _, ref = _resolve_context(context)
+        for a, b in zip(prefix, ref):
+            assert all(np.all(x == y) for x, y in zip(a, b))
+    finally:
+        del util.worker_contexts['test_token']
+
+
 @only_if_pyrosetta
 def test_grow_cycle(c1pose):
     helix = Spliceable(c1pose, sites=[(1, 'N'), ('-4:', 'C')])
@@ -263,6 +459,444 @@ def test_grow_cycle(c1pose):
     assert 0.1411 < np.min(worms.scores) < 0.1412
 
 
+@only_if_pyrosetta
+def test_grow_cycle_f4(c1pose):
+    helix = Spliceable(c1pose, sites=[(1, 'N'), ('-4:', 'C')])
+    segments = ([Segment([helix], exit='C'), ] +
+                [Segment([helix], 'N', 'C')] * 3 +
+                [Segment([helix], entry='N')])
+    ref = grow(segments, Cyclic('C2', lever=20), thresh=20)
+    worms = grow(segments, Cyclic('C2', lever=20), thresh=20, precision='f4')
+    assert worms.positions.dtype == np.float64
+    assert np.allclose(worms.scores, ref.scores)
+    assert (set(map(tuple, worms.indices)) == set(map(tuple, ref.indices)))
+    with pytest.raises(ValueError):
+        grow(segments, Cyclic('C2', lever=20), precision='f2')
+    with pytest.raises(ValueError):
+        grow(segments, Cyclic('C2', lever=20), precision='f4', engine='dfs')
+
+
+@only_if_pyrosetta
+def test_grow_rigid_invariant_span(c1pose, c3pose):
+    helix = Spliceable(c1pose, [(':1', 'N'), ('-2:', 'C')])
+    trimer = Spliceable(c3pose, sites=[('1,:1', 'N'), ('1,-1:', 'C'),
+                                       ('2,:1', 'N'), ('2,-1:', 'C')])
+    segments = [Segment([helix], '_C'), Segment([helix], 'NC'),
+                Segment([trimer], 'NC'), Segment([helix], 'NC'),
+                Segment([trimer], 'N_')]
+    crit = Cyclic(3, from_seg=2)
+    fullcrit = Cyclic(3, from_seg=2)
+    fullcrit.rigid_invariant = False
+    ref = grow(segments, fullcrit, thresh=9e9)
+    worms = grow(segments, crit, thresh=9e9)
+    assert worms.detail['search_span'] == (2, 4)
+    assert ref.detail['search_span'] == (0, 4)
+    assert set(map(tuple, worms.indices)) == set(map(tuple, ref.indices))
+    assert np.allclose(np.sort(worms.scores), np.sort(ref.scores))
+    few = grow(segments, crit, thresh=9e9, max_results=3)
+    assert len(few) == 3
+    assert np.all(few.indices[:, 2:] == few.indices[0, 2:])
+    # refining on the span keeps the seeds' choices off it
+    few.indices[:, :2] = np.max(ref.indices[:, :2], axis=0)
+    more = refine(few, thresh=9e9, nchain=3, nstep=20, random_seed=0)
+    assert more.detail['search_span'] == (2, 4)
+    assert np.all(more.indices[:, :2] == few.indices[0, :2])
+
+
+def test_get_chunk_end_seg_tile():
+    from ..search import _get_chunk_end_seg, _chunk_counts
+    assert _get_chunk_end_seg([3, 4, 5, 6], 1, 1e6) == (3, None)
+    sizes = [10, 50000, 10, 10]
+    end, tile = _get_chunk_end_seg(sizes, 1, 1e6)
+    assert (end, tile) == (2, 1562)
+    chunksize, nchunks = _chunk_counts(sizes, end, tile)
+    assert 64 * chunksize <= 1e6
+    assert chunksize * nchunks >= util.bigprod(sizes)
+    end, tile = _get_chunk_end_seg([100000, 10, 10], 4, 1e6)
+    assert (end, tile) == (1, 15625)
+
+
+@only_if_pyrosetta
+def test_grow_tiled_chunks(c1pose):
+    helix = Spliceable(c1pose, sites=[((1, 2), 'N'), ('-3:', 'C')])
+    segments = ([Segment([helix], exit='C'), ] +
+                [Segment([helix], 'N', 'C')] * 3 +
+                [Segment([helix], entry='N')])
+    ref = grow(segments, Cyclic('C2', lever=20), thresh=20)
+    worms = grow(segments, Cyclic('C2', lever=20), thresh=20, memsize=1000)
+    assert worms.detail['tile'] is not None
+    assert np.allclose(worms.scores, ref.scores)
+    assert set(map(tuple, worms.indices)) == set(map(tuple, ref.indices))
+
+
+@only_if_pyrosetta
+def test_grow_batch_same_as_chunks(c1pose):
+    from ..search import _grow_batch, _grow_chunk, _chain_xforms
+    from ..search import _GrowContext
+    helix = Spliceable(c1pose, sites=[(1, 'N'), ('-4:', 'C')])
+    segments = Segments([Segment([helix, helix], exit='C'),
+                         Segment([helix], 'N', 'C'),
+                         Segment([helix], 'N', 'C'),
+                         Segment([helix, helix], entry='N')]).geometry()
+    crit = Cyclic('C2', lever=20)
+    for end, ml in [(1, 0), (2, 0), (1, None)]:
+        samples = list(util.MultiRange([len(s) for s in segments[end:]]))
+        context = _GrowContext(
+            sampsizes=None, njob=1, segments=segments, end=end,
+            criteria=crit, thresh=20, matchlast=ml, every_other=1,
+            max_results=1000, jitcrit=None, tile=None, batch=len(samples),
+            reach=None)
+        segpos, conpos = _chain_xforms(segments[:end])
+        chunks = [_grow_chunk(s, segpos, conpos, context) for s in samples]
+        chunks = [c for c in chunks if c is not None]
+        score, lowidx = _grow_batch(samples, segpos, conpos, context)
+        ref = dict(zip(map(tuple, np.concatenate([c[1] for c in chunks])),
+                       np.concatenate([c[0] for c in chunks])))
+        assert set(map(tuple, lowidx)) == set(ref)
+        assert np.allclose([ref[tuple(i)] for i in lowidx], score)
+
+
+def test_prune_samples_by_chunk_reach(random_segment):
+    from ..search import _chunk_reach, _prune_samples, _chain_xforms
+    from ..search import _GrowContext
+    np.random.seed(0)
+    Seg = random_segment
+    segs = [Seg(5, 0.01, 0.3), Seg(4, 0.01, 0.3), Seg(10, 1, 5),
+            Seg(30, 1, 5)]
+    samples = list(util.MultiRange([10, 30]))
+    for crit in (Cyclic(3, tol=0.5, lever=5), D3(c3=0, c2=-1, tol=0.5,
+                                                  lever=5)):
+        segpos, conpos = _chain_xforms(segs[:2])
+        best = []
+        for samp in samples:
+            con = conpos[-1] @ segs[2].x2exit[samp[0]]
+            pos = segpos + [conpos[-1] @ segs[2].x2orgn[samp[0]],
+                            con @ segs[3].x2orgn[samp[1]]]
+            best.append(np.min(crit.score(segpos=pos)))
+        thresh = np.percentile(best, 5)
+        reach = _chunk_reach(segs, crit, 2)
+        context = _GrowContext(
+            sampsizes=None, njob=1, segments=segs, end=2, criteria=crit,
+            thresh=thresh, matchlast=None, every_other=1, max_results=10,
+            jitcrit=None, tile=None, batch=1, reach=reach)
+        kept = _prune_samples(samples, context, blocksize=50)
+        for samp, b in zip(samples, best):
+            assert samp in kept or b >= thresh
+        # the translation term is what makes the bound tight
+        rotonly = (reach[0], [(rot, None) for rot, trans in reach[1]])
+        loose = _prune_samples(samples, context._replace(reach=rotonly))
+        assert len(kept) < len(samples) / 2 and len(kept) < len(loose)
+
+
+@only_if_pyrosetta
+def test_grow_engine_dfs(helix_dimer_segments):
+    segments = helix_dimer_segments
+    for crit in (Cyclic('C2', lever=20), D2(c2=1, c2b=-1)):
+        ref = grow(segments, crit, thresh=20)
+        worms = grow(segments, crit, thresh=20, engine='dfs')
+        assert set(map(tuple, worms.indices)) == set(map(tuple, ref.indices))
+        assert np.allclose(worms.scores, ref.scores)
+        best = grow(segments, crit, thresh=20, engine='dfs', max_results=3)
+        assert np.allclose(best.scores, ref.scores[:3])
+    with pytest.raises(ValueError):
+        grow(segments, Cyclic('C2'), engine='bogus')
+
+
+@only_if_pyrosetta
+def test_grow_engine_beam(helix_dimer_segments):
+    segments = helix_dimer_segments
+    crit = Cyclic('C2', lever=20)
+    ref = grow(segments, crit, thresh=20)
+    wide = grow(segments, crit, thresh=20, engine='beam', beam_width=10**6)
+    assert set(map(tuple, wide.indices)) == set(map(tuple, ref.indices))
+    narrow = grow(segments, crit, thresh=20, engine='beam', beam_width=20)
+    assert set(map(tuple, narrow.indices)) <= set(map(tuple, ref.indices))
+    assert np.all(narrow.scores < 20)
+    sharded = grow(segments, crit, thresh=20, engine='beam', beam_width=20,
+                   executor=ThreadPoolExecutor, max_workers=3)
+    assert np.allclose(sharded.scores, narrow.scores)
+    assert not util.worker_contexts  # shards got a token, now released
+
+
+@only_if_pyrosetta
+def test_grow_engine_anneal(helix_dimer_segments):
+    segments = helix_dimer_segments
+    crit = Cyclic('C2', lever=20)
+    ref = grow(segments, crit, thresh=20)
+    refset = set(map(tuple, ref.indices))
+    worms = grow(segments, crit, thresh=20, engine='anneal',
+                 engine_args=dict(nchain=100, nstep=200, random_seed=0))
+    assert set(map(tuple, worms.indices)) <= refset
+    assert np.allclose(worms.scores, sorted(worms.scores))
+    few = grow(segments, crit, thresh=20, max_results=2)
+    more = refine(few, thresh=20, nstep=100, maxshift=1, random_seed=0)
+    found = set(map(tuple, more.indices))
+    assert set(map(tuple, few.indices)) <= found <= refset
+
+
+@only_if_pyrosetta
+def test_grow_engine_hierarchical(helix_dimer_segments):
+    segments = helix_dimer_segments
+    for crit in (Cyclic('C2', lever=20), D2(c2=1, c2b=-1)):
+        for thresh in (8, 20):
+            ref = grow(segments, crit, thresh=thresh)
+            worms = grow(segments, crit, thresh=thresh, engine='hierarchical')
+            assert (set(map(tuple, worms.indices)) ==
+                    set(map(tuple, ref.indices)))
+            assert np.allclose(worms.scores, ref.scores)
+    crit = Cyclic('C2', lever=20)
+    ref = grow(segments, crit, thresh=20)
+    quick = grow(segments, crit, thresh=20, engine='hierarchical',
+                 engine_args=dict(stride=2, coarse_thresh=10))
+    assert set(map(tuple, quick.indices)) <= set(map(tuple, ref.indices))
+
+
+@only_if_pyrosetta
+def test_grow_engine_dp(helix_dimer_segments):
+    segments = helix_dimer_segments
+    crit = Cyclic('C2', lever=20)
+    ref = grow(segments, crit, thresh=20)
+    refset = set(map(tuple, ref.indices))
+    every = grow(segments, crit, thresh=20, engine='dp',
+                 engine_args=dict(nkeep=10**6))
+    assert set(map(tuple, every.indices)) == refset
+    assert np.allclose(every.scores, ref.scores)
+    batched = grow(segments, crit, thresh=20, engine='dp', memsize=1e3,
+                   engine_args=dict(nkeep=10**6))
+    assert set(map(tuple, batched.indices)) == refset
+    capped = grow(segments, crit, thresh=20, engine='dp',
+                  engine_args=dict(nkeep=10**6, max_states=10))
+    assert set(map(tuple, capped.indices)) < refset
+    coarse = grow(segments, crit, thresh=20, engine='dp',
+                  engine_args=dict(cart_resl=4, ori_resl=30))
+    assert set(map(tuple, coarse.indices)) <= refset
+    assert np.all(coarse.scores < 20)
+
+
+def test_best_per_group():
+    key = np.array([[0, 1], [0, 1], [2, 0], [0, 1], [2, 0]])
+    value = np.array([3., 1., 5., 2., 4.])
+    assert sorted(engines._best_per_group(key, value, 1)) == [1, 4]
+    assert sorted(engines._best_per_group(key, value, 2)) == [1, 2, 3, 4]
+    assert list(engines._best_per_group(key[:, :0], value, 2)) == [1, 3]
+    assert sorted(engines._best_states(key, value, 2, 3)) == [1, 3, 4]
+    # merging the best of parts keeps the best of all
+    np.random.seed(0)
+    key = np.random.randint(5, size=(100, 2))
+    value = np.random.rand(100)
+    whole = value[engines._best_states(key, value, 2, 7)]
+    part = [np.arange(40), np.arange(40, 100)]
+    part = np.concatenate([p[engines._best_states(key[p], value[p], 2, 7)]
+                           for p in part])
+    merged = value[part][engines._best_states(key[part], value[part], 2, 7)]
+    assert sorted(merged) == sorted(whole)
+
+
+def test_transform_clusters():
+    x = np.stack([htrans([0, 0, 0]), htrans([0.1, 0, 0]),
+                  hrot([0, 0, 1], np.radians(2)) @ htrans([0.1, 0, 0]),
+                  htrans([5, 0, 0]),
+                  htrans([0, 0, 0])])
+    seg = SegmentGeometry.__new__(SegmentGeometry)
+    seg.x2orgn, seg.x2exit = x, x
+    seg.bodyid = np.array([0, 0, 0, 0, 1])
+    seg.entrysiteid = np.zeros(5, dtype='i')
+    seg.exitsiteid = np.ones(5, dtype='i')
+    label = engines.transform_clusters(seg, 0.5, np.radians(5))
+    assert list(label) == [0, 0, 0, 1, 2]
+    label = engines.transform_clusters(seg, 0.5, np.radians(1))
+    assert list(label) == [0, 0, 1, 2, 3]
+
+
+def test_hierarchical_misses_nothing():
+    from homog import rand_xform
+    np.random.seed(0)
+
+    def geometry(nblock, stride):
+        "entries in residue blocks of stride close to a random xform"
+        n = nblock * stride
+        seg = SegmentGeometry.__new__(SegmentGeometry)
+        for name in SegmentGeometry._array_names: setattr(seg, name, None)
+        x = list()
+        for k in range(2):
+            small = hrot(np.random.randn(n, 3), np.random.randn(n) * 0.01,
+                         degrees=False)
+            small[:, :3, 3] = np.random.randn(n, 3) * 0.1
+            block = rand_xform(nblock, cart_sd=5)
+            x.append(np.repeat(block, stride, axis=0) @ small)
+        seg.x2orgn, seg.x2exit = x
+        seg.bodyid = np.zeros(n, dtype='i')
+        seg.entrysiteid = np.zeros(n, dtype='i')
+        seg.exitsiteid = np.ones(n, dtype='i')
+        seg.entryresid = seg.exitresid = np.arange(n)
+        return seg
+
+    segs = [geometry(n, 2) for n in (3, 4, 4, 3)]
+    x2orgn, x2exit = [s.x2orgn for s in segs], [s.x2exit for s in segs]
+    idx = np.stack(np.meshgrid(*[np.arange(len(s)) for s in segs],
+                               indexing='ij'), axis=-1).reshape(-1, 4)
+    pos = np.empty(idx.shape + (4, 4))
+    engines._fold_from(x2orgn, x2exit, idx, pos, np.empty_like(pos), 0)
+    groups = engines.Grouping(segs, [engines.residue_blocks(s, 2)
+                                     for s in segs])
+    rep = np.stack([np.array([m[len(m) // 2] for m in groups.members[j]])[
+        groups.groupof[j][idx[:, j]]] for j in range(4)], axis=1)
+    reppos = np.empty(idx.shape + (4, 4))
+    engines._fold_from(x2orgn, x2exit, rep, reppos, np.empty_like(pos), 0)
+    for crit in (Cyclic(3, tol=0.5, lever=5), D3(c3=0, c2=-1, tol=0.5,
+                                                  lever=5),
+                 D2(c2=0, c2b=-1, tol=0.5, lever=5)):
+        score = crit.score(segpos=[pos[:, j] for j in range(4)])
+        relaxed = groups.relaxed(crit).score(
+            segpos=[reppos[:, j] for j in range(4)])
+        assert np.all(relaxed <= score + 1e-6)
+        thresh = np.percentile(score, 2)
+        assert np.mean(relaxed < thresh) < 0.5  # coarse search prunes
+        found = engines.hierarchical(segs, crit, thresh=thresh, stride=2,
+                                     max_results=10**6)
+        assert set(map(tuple, found[1])) == set(map(tuple,
+                                                    idx[score < thresh]))
+
+
+@only_if_pyrosetta
+def test_grow_cluster_tol(helix_dimer_segments):
+    segments = helix_dimer_segments
+    for crit in (Cyclic('C2', lever=20), D2(c2=1, c2b=-1)):
+        for cluster_tol, max_results in ((0.5, 10000), (3, 10000), (3, 5),
+                                         (100, 10000)):
+            ref = grow(segments, crit, thresh=8, max_results=max_results)
+            for engine in ('enumerate', 'dfs'):
+                worms = grow(segments, crit, thresh=8, engine=engine,
+                             cluster_tol=cluster_tol,
+                             max_results=max_results)
+                assert (set(map(tuple, worms.indices)) ==
+                        set(map(tuple, ref.indices)))
+                assert np.allclose(worms.scores, ref.scores)
+    assert (np.prod(worms.detail['clustered_sizes']) <
+            np.prod(worms.detail['sizes']))
+    with pytest.raises(ValueError):
+        grow(segments, Cyclic('C2', origin_seg=0), thresh=8, cluster_tol=1)
+
+
+def test_rigid_invariant():
+    assert Cyclic(3).rigid_invariant
+    assert not Cyclic(1).rigid_invariant
+    assert not Cyclic(3, origin_seg=1).rigid_invariant
+    assert D3(c3=0, c2=-1).rigid_invariant
+    assert not CriteriaList([Cyclic(3), Cyclic(1)]).rigid_invariant
+
+
+def test_score_lower_bound():
+    from homog import rand_xform
+    segpos = [rand_xform(1000, cart_sd=5) for i in range(3)]
+    segpos[2][:10] = hrot([1, 2, 3], 120) @ segpos[0][:10]
+    for crit in (Cyclic(1), Cyclic(3), Cyclic(3, origin_seg=1),
+                 D3(c3=0, c2=-1), Tetrahedral(c3=0, c3b=-1),
+                 CriteriaList([Cyclic(2), NullCriteria()])):
+        score = crit.score(segpos=segpos)
+        bound = crit.score_lower_bound(segpos=segpos)
+        assert np.all(bound <= score + 1e-6)
+        assert np.mean(bound) > 0.1 * np.mean(score)
+
+
+def test_score_lower_bound_trans_slack():
+    from homog import rand_xform
+    np.random.seed(0)
+    x_from, x_to = rand_xform(1000), rand_xform(1000, cart_sd=10)
+    rot, trans = 0.2, 2.0
+    delta = hrot(np.random.randn(1000, 3), np.random.rand(1000) * rot,
+                 degrees=False)
+    step = np.random.randn(1000, 3)
+    delta[:, :3, 3] = step * (np.random.rand(1000, 1) * trans /
+                              np.linalg.norm(step, axis=1)[:, None])
+    moved = x_to @ delta  # relative xform within rot and trans
+    for crit in (Cyclic(3), D3(c3=0, c2=-1), D2(c2=0, c2b=-1)):
+        segpos = [x_from, x_to]
+        exact = crit.score_lower_bound(segpos, slack=0, trans_slack=0)
+        assert np.allclose(exact, crit.score(segpos))
+        bound = crit.score_lower_bound(segpos, slack=rot, trans_slack=trans)
+        assert np.all(bound <= crit.score([x_from, moved]) + 1e-6)
+        rotonly = crit.score_lower_bound(segpos, slack=rot)
+        assert np.all(rotonly <= bound) and np.mean(rotonly < bound) > 0.2
+
+
+def test_chunk_workspace_reuse():
+    from ..search import _ChunkWorkspace
+    ws = _ChunkWorkspace()
+    a = ws.get('x', (3, 4, 4), 'f8')
+    b = ws.get('x', (2, 4, 4), 'f8')
+    assert b.shape == (2, 4, 4) and np.shares_memory(a, b)
+    c = ws.get('x', (5, 4, 4), 'f8')
+    assert c.shape == (5, 4, 4) and not np.shares_memory(a, c)
+    assert ws.get('x', (5, 4, 4), 'f4').dtype == np.float32
+
+
+def test_chunk_kernel_same_as_numpy(random_segment):
+    from .. import kernels
+    from ..search import _chain_xforms
+    np.random.seed(0)
+    Seg = random_segment
+    segs = [Seg(3), Seg(4), Seg(2), Seg(1)]
+    tail = (1, 0)
+    for crit in (Cyclic(3, lever=10, tol=9e9), D3(c3=0, c2=-1, tol=9e9),
+                 CriteriaList([NullCriteria(), Cyclic(1, tol=9e9)])):
+        segpos, conpos = _chain_xforms(segs[:2])
+        segpos.append(conpos[-1] @ segs[2].x2orgn[tail[0]])
+        conpos.append(conpos[-1] @ segs[2].x2exit[tail[0]])
+        segpos.append(conpos[-1] @ segs[3].x2orgn[tail[1]])
+        ref = crit.score(segpos=segpos)
+        thresh = np.median(ref)
+        x2orgn, x2exit, offsets, nprefix = kernels.prefix_tables(segs[:2])
+        out_score, out_idx = np.empty(12), np.empty(12, dtype='i8')
+        nlow = kernels.chunk_kernel(
+            x2orgn, x2exit, offsets, nprefix,
+            np.stack([segs[2].x2orgn[1], segs[3].x2orgn[0]]),
+            np.stack([segs[2].x2exit[1], segs[3].x2exit[0]]),
+            kernels.encode_criteria(crit, 4), -1, np.ones(1, dtype='?'),
+            thresh, out_score, out_idx)
+        assert np.all(out_idx[:nlow] == np.where(ref.flat < thresh)[0])
+        assert np.allclose(out_score[:nlow], ref[ref < thresh])
+
+
+def test_chain_xforms_positions_used(random_segment):
+    from ..search import _chain_xforms
+    Seg = random_segment
+    segs = [Seg(3), Seg(4), Seg(2)]
+    crit = Cyclic(3, from_seg=1)
+    assert crit.positions_used(5) == {1, 4}
+    assert CriteriaList([crit, NullCriteria()]).positions_used(5) == {1, 4}
+    ref, refcon = _chain_xforms(segs)
+    segpos, conpos = _chain_xforms(segs, crit.positions_used(5))
+    assert segpos[0] is None and segpos[2] is None
+    assert np.all(segpos[1] == ref[1])
+    assert all(np.all(a == b) for a, b in zip(conpos, refcon))
+
+
+@only_if_pyrosetta
+def test_grow_backend_numba(c1pose):
+    pytest.importorskip('numba')
+    helix = Spliceable(c1pose, sites=[(1, 'N'), ('-4:', 'C')])
+    segments = ([Segment([helix], exit='C'), ] +
+                [Segment([helix], 'N', 'C')] * 3 +
+                [Segment([helix], entry='N')])
+    ref = grow(segments, Cyclic('C2', lever=20), thresh=20)
+    worms = grow(segments, Cyclic('C2', lever=20), thresh=20,
+                 backend='numba')
+    assert np.allclose(worms.scores, ref.scores)
+    assert np.all(worms.indices == ref.indices)
+
+
+def test_score_cyclic_kernel_same_as_numpy():
+    x_from, x_to = hrot([1, 0, 0], 0.3), hrot([0, 1, 1], 2.0) @ htrans(
+        [1, 2, 3])
+    for nfold, x in ((1, x_to), (2, x_to), (2, x_from)):
+        crit = Cyclic(nfold, tol=2, lever=30)
+        ref = crit.score([x_from, x])
+        score = kernels._score_cyclic(x_from, x, crit.tol, crit.rot_tol,
+                                      crit.symangle, nfold)
+        assert np.allclose(score, ref, equal_nan=True)
+
+
 @only_if_pyrosetta
 def test_grow_cycle_thread_pool(c1pose):
     helix = Spliceable(c1pose, sites=[(1, 'N'), ('-4:', 'C')])
@@ -1,13 +1,22 @@
 import os
+import sys
 import re
+import uuid
+import shutil
+import tempfile
 import functools as ft
 import itertools as it
 import operator
+import copy
 import numpy as np
 from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from concurrent.futures import as_completed as cf_as_completed
 import multiprocessing
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
 try:
     from pyrosetta import rosetta as ros
 except ImportError:
@@ -92,6 +101,40 @@ def tqdm_parallel_map(pool, function, accumulator,
         pass
 
 
+# search contexts kept resident in this process, by token
+worker_contexts = dict()
+
+
+def init_worker_context(token, context, initializer=None, initargs=()):
+    """executor initializer, keeps a search context resident in the worker,
+    then runs the initializer the caller gave the executor, if any"""
+    worker_contexts[token] = dict(context=context)
+    if initializer is not None: initializer(*initargs)
+
+
+def resident_context(executor, executor_args, context):
+    """token for context registered by init_worker_context and executor_args
+    that install it in the workers, if the workers of executor can keep
+    it; else context itself, to be sent with every job, and executor_args
+
+    process pools take an initializer only from python 3.7, one already in
+    executor_args is chained"""
+    if not isinstance(executor, type): return context, executor_args
+    process = issubclass(executor, ProcessPoolExecutor)
+    if process and sys.version_info < (3, 7): return context, executor_args
+    if not process and not issubclass(
+            executor, (ThreadPoolExecutor, InProcessExecutor)):
+        return context, executor_args
+    token = uuid.uuid4().hex
+    init_worker_context(token, context)
+    if process:
+        executor_args = dict(executor_args, initializer=init_worker_context,
+                             initargs=(token, context,
+                                       executor_args.get('initializer'),
+                                       executor_args.get('initargs', ())))
+    return token, executor_args
+
+
 def numpy_stub_from_rosetta_stub(rosstub):
     npstub = np.zeros((4, 4))
     for i in range(3):
@@ -119,8 +162,42 @@ def rosetta_stub_from_numpy_stub(npstub):
     return rosstub
 
 
+def get_bb_coords(pose, which_resi=None):
+    'N, CA, C coordinates of protein residues, shape (n, 3, 3)'
+    if which_resi is None:
+        which_resi = range(1, pose.size() + 1)
+    residues = [pose.residue(int(ir)) for ir in which_resi]
+    xyz = [r.xyz(atom) for r in residues if r.is_protein()
+           for atom in ('N', 'CA', 'C')]
+    return np.array([(v.x, v.y, v.z) for v in xyz],
+                    dtype='f8').reshape(-1, 3, 3)
+
+
+def bb_stubs_from_coords(coords):
+    'rif style stubs from (..., 3, 3) N, CA, C coords, same as rosetta Stub'
+    coords = np.asarray(coords, dtype='f8')
+    n, ca, c = coords[..., 0, :], coords[..., 1, :], coords[..., 2, :]
+    e1 = n - ca
+    e1 /= np.linalg.norm(e1, axis=-1)[..., None]
+    e3 = np.cross(e1, c - ca)
+    e3 /= np.linalg.norm(e3, axis=-1)[..., None]
+    e2 = np.cross(e3, e1)
+    stubs = np.zeros(coords.shape[:-2] + (4, 4))
+    stubs[..., :3, 0] = e1
+    stubs[..., :3, 1] = e2
+    stubs[..., :3, 2] = e3
+    stubs[..., :3, 3] = ca
+    stubs[..., 3, 3] = 1.0
+    return stubs
+
+
 def get_bb_stubs(pose, which_resi=None):
     'extract rif style stubs from rosetta pose'
+    return bb_stubs_from_coords(get_bb_coords(pose, which_resi))
+
+
+def get_bb_stubs_rosetta(pose, which_resi=None):
+    'reference for get_bb_stubs using rosetta Stub, one residue at a time'
     if which_resi is None:
         which_resi = list(range(1, pose.size() + 1))
     npstubs = []
@@ -134,6 +211,20 @@ def get_bb_stubs(pose, which_resi=None):
     return np.stack(npstubs)
 
 
+def rigid_inv(xforms):
+    """inverse of a stack of rigid 4x4 homogeneous transforms
+
+    transposes the rotation instead of a general LU inverse, about ten
+    times faster than np.linalg.inv on large stacks"""
+    inverse = np.empty_like(xforms)
+    rot_t = np.swapaxes(xforms[..., :3, :3], -1, -2)
+    inverse[..., :3, :3] = rot_t
+    inverse[..., :3, 3] = -np.einsum('...ij,...j->...i', rot_t,
+                                     xforms[..., :3, 3])
+    inverse[..., 3, :] = (0, 0, 0, 1)
+    return inverse
+
+
 def pose_bounds(pose, lb, ub):
     if ub < 0: ub = len(pose) + 1 + ub
     if lb < 1 or ub > len(pose):
@@ -252,6 +343,200 @@ def get_symdata_modified(name,
     return d
 
 
+def save_arrays(path, arrays):
+    """write dict of arrays as .npy files in directory path
+
+    the directory is built under a temporary name and renamed into place,
+    so concurrent writers and readers never see a partial cache entry"""
+    if os.path.exists(path): return
+    parent, name = os.path.split(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix='.' + name, dir=parent)
+    for k, v in arrays.items():
+        np.save(os.path.join(tmp, k + '.npy'), np.ascontiguousarray(v))
+    try:
+        os.rename(tmp, path)
+    except OSError:  # someone else got there first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_arrays(path, names, mmap_mode='r'):
+    """load arrays written by save_arrays, memory-mapped by default,
+    returns None if the cache entry doesn't exist"""
+    if not os.path.isdir(path): return None
+    return {k: np.load(os.path.join(path, k + '.npy'), mmap_mode=mmap_mode)
+            for k in names}
+
+
+_attached_shm = dict()
+
+
+class SharedArray:
+    "name, shape and dtype of an array in a shared_memory block"
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    def attach(self):
+        "zero-copy view of the array, blocks are opened once per process"
+        if self.name not in _attached_shm:
+            _attached_shm[self.name] = shared_memory.SharedMemory(self.name)
+        buf = _attached_shm[self.name].buf
+        return np.ndarray(self.shape, self.dtype, buffer=buf)
+
+
+class SharedArrayPool:
+    """owns the shared_memory blocks made by share(), unlinked on exit
+
+    use only when shared_memory is available (python >= 3.8)"""
+
+    def __init__(self):
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        for shm in self.blocks:
+            _attached_shm.pop(shm.name, None)
+            shm.close()
+            shm.unlink()
+        self.blocks = []
+
+    def share(self, ary):
+        ary = np.ascontiguousarray(ary)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, ary.nbytes))
+        self.blocks.append(shm)
+        np.ndarray(ary.shape, ary.dtype, buffer=shm.buf)[...] = ary
+        return SharedArray(shm.name, ary.shape, ary.dtype.str)
+
+
+class SharedArraysMixin:
+    """pickle the arrays named in _array_names as SharedArray descriptors
+
+    call shared(pool) to get a copy whose arrays live in pool; pickling the
+    copy then costs a few bytes per array, and unpickling attaches"""
+
+    _array_names = ()
+
+    def shared(self, pool):
+        new = copy.copy(self)
+        new._shared = dict()
+        for k in self._array_names:
+            val = getattr(self, k)
+            if isinstance(val, SharedArraysMixin):
+                setattr(new, k, val.shared(pool))
+            elif val is not None:
+                new._shared[k] = pool.share(val)
+        return new
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for k in state.get('_shared', ()):
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for k, v in state.get('_shared', {}).items():
+            setattr(self, k, v.attach())
+
+
+class FactorizedXforms(SharedArraysMixin):
+    """read-only stack of xforms left[ileft] @ right[iright], formed on access
+
+    right may be None, then the stack is just left[ileft]. indexing works like
+    an (n, 4, 4) array on the first axis, np.asarray materializes it all"""
+
+    _array_names = ('left', 'ileft', 'right', 'iright')
+
+    def __init__(self, left, ileft, right=None, iright=None):
+        self.left = left
+        self.ileft = np.asarray(ileft)
+        self.right = right
+        self.iright = None if iright is None else np.asarray(iright)
+        if right is not None and self.iright.shape != self.ileft.shape:
+            raise ValueError('ileft and iright must have same shape')
+
+    def __getitem__(self, idx):
+        x = self.left[self.ileft[idx]]
+        if self.right is not None:
+            x = x @ self.right[self.iright[idx]]
+        return x
+
+    def astype(self, dtype):
+        right = None if self.right is None else self.right.astype(dtype)
+        return FactorizedXforms(self.left.astype(dtype), self.ileft,
+                                right, self.iright)
+
+    def __array__(self, dtype=None, copy=None):
+        x = self[:]
+        return x if dtype is None else x.astype(dtype)
+
+    def __len__(self):
+        return len(self.ileft)
+
+    @property
+    def shape(self):
+        return self.ileft.shape + self.left.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.left.dtype
+
+    @property
+    def nbytes(self):
+        return sum(x.nbytes for x in (self.left, self.ileft,
+                                      self.right, self.iright)
+                   if x is not None)
+
+
+class KeyIndex:
+    """sorted array of integer key tuples, for fast joins
+
+    columns are packed into one int64 per row (mixed radix over the range of
+    each column) and looked up with searchsorted; lookup() gives the row of
+    each query key, -1 where it is absent. keys are assumed unique"""
+
+    def __init__(self, *columns):
+        columns = [np.asarray(c, dtype='i8') for c in columns]
+        n = len(columns[0])
+        self.lb = np.array([c.min() if n else 0 for c in columns], dtype='i8')
+        self.ub = np.array([c.max() if n else -1 for c in columns], dtype='i8')
+        span = [int(x) for x in self.ub - self.lb + 1]
+        if bigprod(span) >= 2**63:
+            raise ValueError('KeyIndex key range too large for int64')
+        self.radix = np.array([bigprod(span[i + 1:])
+                               for i in range(len(span))], dtype='i8')
+        keys, _ = self.pack(*columns)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    def pack(self, *columns):
+        "packed keys and mask of rows inside the indexed key range"
+        columns = np.broadcast_arrays(*[np.asarray(c, dtype='i8')
+                                        for c in columns])
+        keys = np.zeros(columns[0].shape, dtype='i8')
+        inbounds = np.ones(columns[0].shape, dtype='?')
+        for c, lb, ub, radix in zip(columns, self.lb, self.ub, self.radix):
+            inbounds &= (lb <= c) & (c <= ub)
+            keys += (c - lb) * radix
+        return keys, inbounds
+
+    def lookup(self, *columns):
+        query, inbounds = self.pack(*columns)
+        if len(self.keys) == 0:
+            return np.full(query.shape, -1, dtype='i8')
+        pos = np.minimum(np.searchsorted(self.keys, query), len(self.keys) - 1)
+        found = (self.keys[pos] == query) & inbounds
+        return np.where(found, self.order[pos], -1)
+
+    def __len__(self):
+        return len(self.keys)
+
+
 def infer_cyclic_symmetry(pose):
     raise NotImplementedError
 
@@ -1,5 +1,8 @@
 import multiprocessing
 import os
+import hashlib
+import copy
+import weakref
 import itertools as it
 from collections.abc import Iterable
 from collections import defaultdict, OrderedDict
@@ -146,6 +149,15 @@ class Spliceable:
         assert np.all(to_subset[resid_subset] == np.arange(len(resid_subset)))
         return resid_subset, to_subset
 
+    def _splice_backbone(self):
+        """spliceable_positions and N, CA, C coords there, read from body
+        by the first Segment and kept for the others"""
+        if '_backbone' not in self.__dict__:
+            resid_subset, to_subset = self.spliceable_positions()
+            self._backbone = (resid_subset, to_subset,
+                              util.get_bb_coords(self.body, resid_subset))
+        return self._backbone
+
     def is_compatible(self, isite, ires, jsite, jres):
         if ires < 0 or jres < 0: return True
         assert 0 < ires <= self._len_body and 0 < jres <= self._len_body
@@ -159,6 +171,28 @@ class Spliceable:
             if seglen < self.min_seg_len: return False
         return True
 
+    def compatibility_mask(self, isite, ires, jsite, jres):
+        """vectorized sitepair_allowed and is_compatible, inputs broadcast"""
+        isite, ires, jsite, jres = np.broadcast_arrays(
+            *map(np.asarray, (isite, ires, jsite, jres)))
+        ok = isite != jsite
+        if self.allowed_pairs is not None:
+            allowed = np.zeros((len(self.sites), ) * 2, dtype='?')
+            for ipair, jpair in self.allowed_pairs:
+                allowed[ipair, jpair] = True
+            either_none = (isite < 0) | (jsite < 0)
+            ok &= either_none | allowed[np.maximum(isite, 0),
+                                        np.maximum(jsite, 0)]
+        both_res = (ires > 0) & (jres > 0)
+        ichain = self._chains[np.maximum(ires, 1) - 1]
+        jchain = self._chains[np.maximum(jres, 1) - 1]
+        same_chain = both_res & (ichain == jchain)
+        sitepol = np.array([s.polarity == 'N' for s in self.sites] + [0])
+        ipol_n, jpol_n = sitepol[isite], sitepol[jsite]
+        seglen = np.where(ipol_n, jres - ires + 1, ires - jres + 1)
+        bad = (ipol_n == jpol_n) | (seglen < self.min_seg_len)
+        return ok & ~(same_chain & bad)
+
     def sitepair_allowed(self, isite, jsite):
         if isite == jsite:
             return False
@@ -185,6 +219,22 @@ class Spliceable:
     # self.__init__(body, state[1], bodyid=state[2], min_seg_len=state[3])
 
 
+class SpliceableGeometry:
+    "pose-free part of a Spliceable: ids, chain bounds and site counts"
+
+    def __init__(self, spliceable):
+        self.bodyid = spliceable.bodyid
+        self.start_of_chain = dict(spliceable.start_of_chain)
+        self.end_of_chain = dict(spliceable.end_of_chain)
+        self.nsite = dict(spliceable.nsite)
+        self.min_seg_len = spliceable.min_seg_len
+        self.allowed_pairs = spliceable.allowed_pairs
+
+    def __repr__(self):
+        return 'SpliceableGeometry(bodyid=%s, nchain=%i)' % (
+            self.bodyid, len(self.end_of_chain))
+
+
 class AnnoPose:
     def __init__(self, pose, iseg, srcpose, src_lb, src_ub, cyclic_entry):
         self.pose = pose
@@ -214,8 +264,45 @@ def lineno():
     return inspect.currentframe().f_back.f_lineno
 
 
+class _SegmentData:
+    "stubs and arrays shared by every Segment with the same definition"
+
+    _names = ('resid_subset', 'to_subset', 'stubs', 'min_sites', 'max_sites',
+              'x2exit', 'x2orgn', 'entrysiteid', 'entryresid',
+              'exitsiteid', 'exitresid', 'bodyid')
+
+    def __init__(self, segment):
+        for name in self._names:
+            setattr(self, name, getattr(segment, name))
+
+    def apply(self, segment):
+        for name in self._names:
+            setattr(segment, name, getattr(self, name))
+        segment.min_sites = dict(self.min_sites)
+        segment.max_sites = dict(self.max_sites)
+        segment._data = self
+
+
+_segment_data = weakref.WeakValueDictionary()
+
+
+def _segment_data_key(content_key, cache_dir, compact, derived=None):
+    """content_key: Segment._cache_key of the Segment or the one it was
+    derived from; derived: how the rows were made from that Segment, so
+    derived heads/tails never stand in for plain Segments"""
+    return (content_key, cache_dir, compact, derived)
+
+
 class Segment:
-    def __init__(self, spliceables, entry=None, exit=None, expert=False):
+    _array_names = ('x2exit', 'x2orgn', 'entrysiteid', 'entryresid',
+                      'exitsiteid', 'exitresid', 'bodyid')
+
+    def __init__(self, spliceables, entry=None, exit=None, expert=False,
+                 cache_dir=None, compact=False):
+        """cache_dir: if given, segment arrays are stored there keyed by
+        content and memory-mapped on later runs
+        compact: keep x2exit/x2orgn as util.FactorizedXforms, per residue
+        stubs plus pair indices, instead of one 4x4 per entry/exit pair"""
         if entry and len(entry) is 2:
             entry, exit = entry
             if entry == '_': entry = None
@@ -223,6 +310,10 @@ class Segment:
         self.entrypol = entry
         self.exitpol = exit
         self.expert = expert
+        self.cache_dir = cache_dir
+        self.compact = compact
+        if compact and cache_dir is not None:
+            raise ValueError('compact Segments can not use cache_dir')
         if entry not in ('C', 'N', None):
             raise ValueError('bad entry: "%s" type %s' % (entry, type(entry)))
         if exit not in ('C', 'N', None):
@@ -242,33 +333,124 @@ class Segment:
                 raise ValueError('different number of chains for spliceables',
                                  ' in segment (pass expert=True to ignore)')
             self.nchains = max(self.nchains, len(s.chains))
-        self.resid_subset, self.to_subset, self.stubs = [], [], []
+        self.resid_subset, self.to_subset, bbcoords = [], [], []
         for ibody, spliceable in enumerate(self.spliceables):
             for p in 'NC':
                 self.min_sites[p] = min(self.min_sites[p], spliceable.nsite[p])
                 self.max_sites[p] = max(self.max_sites[p], spliceable.nsite[p])
-            resid_subset, to_subset = spliceable.spliceable_positions()
-            stubs = util.get_bb_stubs(spliceable.body, resid_subset)
+            resid_subset, to_subset, crd = spliceable._splice_backbone()
             self.resid_subset.append(resid_subset)
             self.to_subset.append(to_subset)
-            self.stubs.append(stubs)
-        self.init_segment_data()
+            bbcoords.append(crd)
+        # by content, so a changed Spliceable never gets stale arrays
+        self._content_key = self._cache_key(bbcoords)
+        key = _segment_data_key(self._content_key, cache_dir, compact)
+        if key in _segment_data:
+            _segment_data[key].apply(self)
+            return
+        if cache_dir is None:
+            self.stubs = [util.bb_stubs_from_coords(c) for c in bbcoords]
+            self.init_segment_data()
+        else:
+            path = os.path.join(cache_dir, self._content_key)
+            names = self._array_names + ('stubs',)
+            arrays = util.load_arrays(path, names)
+            if arrays is None:
+                self.stubs = [util.bb_stubs_from_coords(c) for c in bbcoords]
+                self.init_segment_data()
+                arrays = {k: getattr(self, k) for k in self._array_names}
+                util.save_arrays(path, dict(
+                    arrays, stubs=np.concatenate(self.stubs)))
+                arrays = util.load_arrays(path, names)
+            # stubs of all bodies are stored as one array
+            split = np.cumsum([len(c) for c in bbcoords])[:-1]
+            self.stubs = np.split(arrays.pop('stubs'), split)
+            for k, v in arrays.items():
+                setattr(self, k, v)
+        self._share_data()
+
+    def _share_data(self, key=None):
+        "register arrays so identically defined Segments reuse them"
+        self._data = _SegmentData(self)
+        if key is None:
+            key = _segment_data_key(self._content_key, self.cache_dir,
+                                    self.compact)
+        _segment_data[key] = self._data
+
+    def _cache_key(self, bbcoords):
+        """hash of everything init_segment_data output depends on"""
+        sha = hashlib.sha1(b'worms Segment v2')
+        sha.update(repr((self.entrypol, self.exitpol)).encode())
+        for ibody, spliceable in enumerate(self.spliceables):
+            resid_subset = self.resid_subset[ibody]
+            sha.update(np.ascontiguousarray(bbcoords[ibody]).tobytes())
+            sha.update(np.asarray(resid_subset, dtype='i8').tobytes())
+            sha.update(spliceable._chains[resid_subset - 1].tobytes())
+            sites = [(s.polarity, spliceable.resids(i))
+                     for i, s in enumerate(spliceable.sites)]
+            allowed = (None if spliceable.allowed_pairs is None else
+                       sorted(spliceable.allowed_pairs))
+            sha.update(repr((ibody, spliceable.bodyid, sites, allowed,
+                             spliceable.min_seg_len)).encode())
+        return sha.hexdigest()
 
     def make_head(self):
+        """Segment with this entry and no exit
+
+        rows are the distinct entries of this Segment, ordered by bodyid,
+        entrysiteid and entryresid, so entries with no valid exit are left
+        out"""
         assert not (self.entrypol is None or self.exitpol is None)
-        return Segment(
-            self.spliceables,
-            entry=self.entrypol,
-            exit=None,
-            expert=self.expert)
+        uniq = self._first_rows('bodyid', 'entrysiteid', 'entryresid')
+        nope = np.repeat(-1, len(uniq))
+        x2orgn = self.x2orgn[uniq]
+        return self._derive(self.entrypol, None, x2exit=x2orgn, x2orgn=x2orgn,
+                            entrysiteid=self.entrysiteid[uniq],
+                            entryresid=self.entryresid[uniq],
+                            exitsiteid=nope, exitresid=nope,
+                            bodyid=self.bodyid[uniq])
 
     def make_tail(self):
+        """Segment with no entry and this exit
+
+        rows are the distinct exits of this Segment, ordered by bodyid,
+        exitsiteid and exitresid like those of a Segment with no entry, so
+        exits with no valid entry are left out"""
         assert not (self.entrypol is None or self.exitpol is None)
-        return Segment(
-            self.spliceables,
-            entry=None,
-            exit=self.exitpol,
-            expert=self.expert)
+        uniq = self._first_rows('bodyid', 'exitsiteid', 'exitresid')
+        nope = np.repeat(-1, len(uniq))
+        x2exit = util.rigid_inv(self.x2orgn[uniq]) @ self.x2exit[uniq]
+        x2orgn = np.repeat(np.eye(4)[None], len(uniq), axis=0)
+        return self._derive(None, self.exitpol, x2exit=x2exit, x2orgn=x2orgn,
+                            entrysiteid=nope, entryresid=nope,
+                            exitsiteid=self.exitsiteid[uniq],
+                            exitresid=self.exitresid[uniq],
+                            bodyid=self.bodyid[uniq])
+
+    def _first_rows(self, *names):
+        "index of the first row of each distinct key, in key order"
+        keys = np.stack([getattr(self, n) for n in names], axis=1)
+        _, first = np.unique(keys, axis=0, return_index=True)
+        return first
+
+    def _derive(self, entrypol, exitpol, **arrays):
+        "Segment sharing stubs and spliceables with this one, new arrays"
+        derived = ('head' if exitpol is None else 'tail', self.entrypol,
+                   self.exitpol)
+        key = _segment_data_key(self._content_key, self.cache_dir,
+                                self.compact, derived)
+        seg = copy.copy(self)
+        seg.__dict__.pop('_key_indices', None)
+        seg.entrypol, seg.exitpol = entrypol, exitpol
+        if key in _segment_data:
+            _segment_data[key].apply(seg)
+            return seg
+        seg.min_sites = dict(self.min_sites)
+        seg.max_sites = dict(self.max_sites)
+        for k, v in arrays.items():
+            setattr(seg, k, v)
+        seg._share_data(key)
+        return seg
 
     def merge_idx_slow(self, head, head_idx, tail, tail_idx):
         "return joint index, -1 if head/tail pairing is invalid"
@@ -294,17 +476,62 @@ class Segment:
                 idx[i] = tmp[0]
         return idx
 
+    def merge_idx_fast(self, head, head_idx, tail, tail_idx):
+        "return joint index, -1 if head/tail pairing is invalid"
+        head_idx, tail_idx = map(np.asarray, [head_idx, tail_idx])
+        assert not (self.entrypol is None or self.exitpol is None)
+        assert head.exitpol is None and tail.entrypol is None
+        assert head_idx.shape == tail_idx.shape
+        assert head_idx.ndim == 1
+        index = self.key_index('bodyid', 'entryresid', 'entrysiteid',
+                               'exitresid', 'exitsiteid')
+        bodyid = head.bodyid[head_idx]
+        idx = index.lookup(bodyid,
+                           head.entryresid[head_idx],
+                           head.entrysiteid[head_idx],
+                           tail.exitresid[tail_idx],
+                           tail.exitsiteid[tail_idx])
+        idx[bodyid != tail.bodyid[tail_idx]] = -1
+        return idx
+
     def merge_idx(self, head, head_idx, tail, tail_idx):
         ok1 = (head.bodyid[head_idx] == tail.bodyid[tail_idx])
         ok2 = (head.entrysiteid[head_idx] != tail.exitsiteid[tail_idx])
         ok = np.logical_and(ok1, ok2)
-        return self.merge_idx_slow(head, head_idx[ok], tail, tail_idx[ok]), ok
+        return self.merge_idx_fast(head, head_idx[ok], tail, tail_idx[ok]), ok
 
     def split_idx(self, idx, head, tail):
         """return indices for separate head and tail segments"""
         assert not (self.entrypol is None or self.exitpol is None)
         assert head.exitpol is None and tail.entrypol is None
         assert idx.ndim == 1
+        head_idx = head.key_index('bodyid', 'entryresid', 'entrysiteid'
+                                  ).lookup(self.bodyid[idx],
+                                           self.entryresid[idx],
+                                           self.entrysiteid[idx])
+        tail_idx = tail.key_index('bodyid', 'exitresid', 'exitsiteid'
+                                  ).lookup(self.bodyid[idx],
+                                           self.exitresid[idx],
+                                           self.exitsiteid[idx])
+        bad = (idx < 0) | (head_idx < 0) | (tail_idx < 0)
+        head_idx[bad] = -1
+        tail_idx[bad] = -1
+        return head_idx, tail_idx
+
+    def key_index(self, *names):
+        "util.KeyIndex on the named id arrays, built once per Segment"
+        if '_key_indices' not in self.__dict__:
+            self._key_indices = dict()
+        if names not in self._key_indices:
+            self._key_indices[names] = util.KeyIndex(
+                *[getattr(self, n) for n in names])
+        return self._key_indices[names]
+
+    def split_idx_slow(self, idx, head, tail):
+        "reference implementation, see split_idx"
+        assert not (self.entrypol is None or self.exitpol is None)
+        assert head.exitpol is None and tail.entrypol is None
+        assert idx.ndim == 1
         head_idx = np.zeros_like(idx) - 1
         tail_idx = np.zeros_like(idx) - 1
         for i in range(len(idx)):
@@ -343,6 +570,71 @@ class Segment:
         return len(self.bodyid)
 
     def init_segment_data(self):
+        # each array has all in/out pairs, ordered by body, entry site,
+        # entry res, exit site, exit res as in init_segment_data_slow
+        entry_tab, exit_tab, ientry_all, iexit_all, bodyid = [], [], [], [], []
+        entryresid, exitresid, entrysiteid, exitsiteid = [], [], [], []
+        nentry = nexit = 0
+        for ibody, spliceable in enumerate(self.spliceables):
+            for p in 'NC':
+                self.min_sites[p] = min(self.min_sites[p], spliceable.nsite[p])
+                self.max_sites[p] = max(self.max_sites[p], spliceable.nsite[p])
+            to_subset = self.to_subset[ibody]
+            stubs = self.stubs[ibody]
+            if len(self.resid_subset[ibody]) != stubs.shape[0]:
+                raise ValueError("no funny residues supported")
+            isite, ires = self._splice_positions(spliceable, self.entrypol)
+            jsite, jres = self._splice_positions(spliceable, self.exitpol)
+            ok = spliceable.compatibility_mask(isite[:, None], ires[:, None],
+                                               jsite[None, :], jres[None, :])
+            ientry, iexit = np.nonzero(ok)
+            # stub of a missing entry/exit is the identity
+            stubs = np.concatenate([stubs, np.eye(4)[None]])
+            stubs_inv = util.rigid_inv(stubs)
+            entry_inv = stubs_inv[np.where(ires < 0, -1, to_subset[ires])]
+            exit_stub = stubs[np.where(jres < 0, -1, to_subset[jres])]
+            entry_tab.append(entry_inv)
+            exit_tab.append(exit_stub)
+            ientry_all.append(ientry + nentry)
+            iexit_all.append(iexit + nexit)
+            nentry, nexit = nentry + len(entry_inv), nexit + len(exit_stub)
+            entrysiteid.append(isite[ientry])
+            entryresid.append(ires[ientry])
+            exitsiteid.append(jsite[iexit])
+            exitresid.append(jres[iexit])
+            bid = ibody if spliceable.bodyid is None else spliceable.bodyid
+            bodyid.append(np.repeat(bid, len(ientry)))
+        if sum(len(x) for x in ientry_all) == 0:
+            raise ValueError('no valid splices found')
+        entry_tab, exit_tab = map(np.concatenate, (entry_tab, exit_tab))
+        ientry, iexit = map(np.concatenate, (ientry_all, iexit_all))
+        if self.compact:
+            self.x2exit = util.FactorizedXforms(entry_tab, ientry,
+                                                exit_tab, iexit)
+            self.x2orgn = util.FactorizedXforms(entry_tab, ientry)
+        else:
+            self.x2exit = entry_tab[ientry] @ exit_tab[iexit]
+            self.x2orgn = entry_tab[ientry]
+        self.entrysiteid = np.concatenate(entrysiteid)
+        self.entryresid = np.concatenate(entryresid)
+        self.exitsiteid = np.concatenate(exitsiteid)
+        self.exitresid = np.concatenate(exitresid)
+        self.bodyid = np.concatenate(bodyid)
+
+    @staticmethod
+    def _splice_positions(spliceable, polarity):
+        """site and resid of each splice position with polarity, -1 if None"""
+        if polarity is None:
+            return np.array([-1]), np.array([-1])
+        sites, resids = [], []
+        for isite, site in enumerate(spliceable.sites):
+            if site.polarity == polarity:
+                resids.extend(spliceable.resids(isite))
+                sites.extend([isite] * len(spliceable.resids(isite)))
+        return np.array(sites, dtype='i8'), np.array(resids, dtype='i8')
+
+    def init_segment_data_slow(self):
+        "reference implementation, see init_segment_data"
         # print('init_segment_data', len(self.spliceables))
         # each array has all in/out pairs
         self.x2exit, self.x2orgn, self.bodyid = [], [], []
@@ -413,6 +705,10 @@ class Segment:
         self.exitresid = np.array(self.exitresid)
         self.bodyid = np.array(self.bodyid)
 
+    def geometry(self):
+        "pose-free SegmentGeometry view of this Segment"
+        return SegmentGeometry(self)
+
     def same_bodies_as(self, other):
         bodies1 = [s.body for s in self.spliceables]
         bodies2 = [s.body for s in other.spliceables]
@@ -566,6 +862,46 @@ class Segment:
         return enex, rest
 
 
+class SegmentGeometry(util.SharedArraysMixin):
+    """pose-free view of a Segment: transform arrays, ids and chain bounds
+
+    this is what search workers get; it is cheap to pickle and holds no
+    references to poses, so grow never has to touch the user's objects"""
+
+    _array_names = Segment._array_names
+
+    def __init__(self, segment):
+        self.entrypol = segment.entrypol
+        self.exitpol = segment.exitpol
+        self.min_sites = dict(segment.min_sites)
+        self.max_sites = dict(segment.max_sites)
+        self.spliceables = [SpliceableGeometry(s)
+                            for s in segment.spliceables]
+        for name in Segment._array_names:
+            setattr(self, name, getattr(segment, name))
+
+    def geometry(self):
+        return self
+
+    def astype(self, dtype):
+        "copy with x2exit and x2orgn cast to dtype"
+        new = copy.copy(self)
+        new.x2exit = self.x2exit.astype(dtype)
+        new.x2orgn = self.x2orgn.astype(dtype)
+        return new
+
+    def subset(self, rows):
+        "shallow copy with only the entries in rows"
+        new = copy.copy(self)
+        for name in self._array_names:
+            x = getattr(self, name)
+            if x is not None: setattr(new, name, x[rows])
+        return new
+
+    def __len__(self):
+        return len(self.bodyid)
+
+
 class Segments:
     "light wrapper around list of Segments"
 
@@ -589,6 +925,18 @@ class Segments:
     def index(self, val):
         return self.segments.index(val)
 
+    def geometry(self):
+        "Segments of pose-free SegmentGeometry views"
+        return Segments([s.geometry() for s in self.segments])
+
+    def astype(self, dtype):
+        "Segments of SegmentGeometry with transforms cast to dtype"
+        return Segments([s.geometry().astype(dtype) for s in self.segments])
+
+    def shared(self, pool):
+        "Segments with arrays moved into util.SharedArrayPool pool"
+        return Segments([s.shared(pool) for s in self.segments])
+
     def split_at(self, idx):
         tail, head = self[:idx + 1], self[idx:]
         tail[-1] = tail[-1].make_head()